@@ -1,5 +1,8 @@
 from django.contrib import admin
 from django.contrib.admin import SimpleListFilter
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from address.models import *
 
 class UnidentifiedListFilter(SimpleListFilter):
@@ -13,6 +16,39 @@ class UnidentifiedListFilter(SimpleListFilter):
         if self.value() == 'unidentified':
             return queryset.filter(locality=None)
 
+##
+## Counting every row of a large table takes a full scan on most databases,
+## so unfiltered changelists use the planner's estimate instead. Filtered
+## ones, and small tables, are still counted exactly.
+##
+class EstimatedCountPaginator(Paginator):
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = self.estimate()
+            if estimate is not None and estimate >= self.estimate_threshold:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+    def estimate(self):
+        connection = connections[self.object_list.db]
+        table = self.object_list.model._meta.db_table
+        if connection.vendor == 'postgresql':
+            sql = 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass'
+            params = [connection.ops.quote_name(table)]
+        elif connection.vendor == 'mysql':
+            sql = 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s'
+            params = [table]
+        else:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        return int(row[0]) if row and row[0] is not None else None
+
 @admin.register(Country)
 class CountryAdmin(admin.ModelAdmin):
     search_fields = ('name', 'code')
@@ -20,12 +56,51 @@ class CountryAdmin(admin.ModelAdmin):
 @admin.register(State)
 class StateAdmin(admin.ModelAdmin):
     search_fields = ('name', 'code')
+    list_select_related = ('country',)
+    autocomplete_fields = ('country',)
+
+    def get_queryset(self, request):
+        # States are listed with their country, including in autocompletes.
+        return super(StateAdmin, self).get_queryset(request).select_related('country')
 
 @admin.register(Locality)
 class LocalityAdmin(admin.ModelAdmin):
     search_fields = ('name', 'postal_code')
+    autocomplete_fields = ('state',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    # The model's ordering sorts through the state and country tables.
+    ordering = ('-pk',)
+
+    def get_queryset(self, request):
+        return super(LocalityAdmin, self).get_queryset(request).with_hierarchy()
+
+    def get_search_results(self, request, queryset, search_term):
+        # Match the start of names and postal codes on their indexes.
+        search_term = ' '.join(search_term.split())
+        if search_term:
+            queryset = queryset.search(search_term)
+        return queryset, False
 
 @admin.register(Address)
 class AddressAdmin(admin.ModelAdmin):
-    search_fields = ('name',)
+    search_fields = ('search',)
+    list_display = ('__str__', 'locality')
     list_filter = (UnidentifiedListFilter,)
+    list_select_related = ('locality__state__country',)
+    autocomplete_fields = ('locality',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    # The model's ordering sorts through the locality, state and country
+    # tables, which means joining and sorting the whole table for each page.
+    ordering = ('-pk',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # Match the start of the display string on its indexed column,
+        # rather than scanning with a case insensitive LIKE.
+        search_term = ' '.join(search_term.split())
+        if search_term:
+            queryset = queryset.search(search_term)
+        return queryset, False
@@ -0,0 +1,48 @@
+"""
+Coroutine versions of `to_python` and `bulk_to_python` for async views.
+
+The versions of Django this app supports have no async ORM, so each call
+resolves the whole address hierarchy in a single hop to a worker thread,
+rather than hopping once per query. With asgiref installed (as it is under
+any ASGI server) Django's own thread sensitive executor is used, otherwise
+a dedicated thread does the same job.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+
+from address.models import bulk_to_python, to_python
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+__all__ = ['ato_python', 'abulk_to_python']
+
+_executor = None
+
+def _run(func, *args, **kwargs):
+    global _executor
+    if sync_to_async is not None:
+        return sync_to_async(func, thread_sensitive=True)(*args, **kwargs)
+
+    # Database connections belong to a thread, so run everything on the same one.
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def ato_python(value):
+    """
+    Convert a value to an address as `address.models.to_python` does. Returns
+    an awaitable.
+    """
+    return _run(to_python, value)
+
+def abulk_to_python(values, batch_size=250):
+    """
+    Convert dictionaries to addresses as `address.models.bulk_to_python`
+    does. Returns an awaitable.
+    """
+    return _run(bulk_to_python, list(values), batch_size=batch_size)
@@ -1,4 +1,6 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
+from django.test.signals import setting_changed
 
 
 class AddressConfig(AppConfig):
@@ -6,3 +8,15 @@ class AddressConfig(AppConfig):
     Define config for the member app so that we can hook in signals.
     """
     name = 'address'
+
+    def ready(self):
+        from address import cache, geocoders, metrics
+        from address.models import refresh_display
+        for model_name in ('Country', 'State', 'Locality'):
+            model = self.get_model(model_name)
+            post_save.connect(cache.invalidate, sender=model, dispatch_uid='address_cache_%s_save' % model_name)
+            post_delete.connect(cache.invalidate, sender=model, dispatch_uid='address_cache_%s_delete' % model_name)
+            post_save.connect(refresh_display, sender=model, dispatch_uid='address_display_%s_save' % model_name)
+        setting_changed.connect(cache.reset_cache, dispatch_uid='address_cache_setting_changed')
+        setting_changed.connect(metrics.reset_sink, dispatch_uid='address_metrics_setting_changed')
+        setting_changed.connect(geocoders.reset_geocoder, dispatch_uid='address_geocoder_setting_changed')
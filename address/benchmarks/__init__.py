@@ -0,0 +1,267 @@
+"""
+Benchmarks of the address resolution path. Each case reports the number of
+queries and the wall time per call, and is run by the `benchmark_addresses`
+management command.
+"""
+from collections import OrderedDict
+from random import Random
+import atexit
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from django.db import connection
+
+from address.models import Address, bulk_to_python, to_python
+
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+# Python 3 fixes.
+import sys
+
+if sys.version > '3':
+    unicode = str
+
+__all__ = ['CASES', 'SCALED_CASES', 'make_components', 'measure']
+
+CASES = OrderedDict()
+SCALED_CASES = OrderedDict()
+
+def case(name, scaled=False):
+    def wrap(func):
+        (SCALED_CASES if scaled else CASES)[name] = func
+        return func
+    return wrap
+
+def make_components(ii, prefix=''):
+    """
+    Build a deterministic component dictionary. Addresses spread over 500
+    localities, 10 states and 2 countries.
+    """
+    country = ('Australia', 'AU') if ii % 2 else ('New Zealand', 'NZ')
+    state = 'State %d' % (ii % 10)
+    locality = 'Locality %d' % (ii % 500)
+    return {
+        'raw': '%s%d Some Street, %s, %s, %s' % (prefix, ii, locality, state, country[0]),
+        'street_number': '%s%d' % (prefix, ii),
+        'route': 'Some Street',
+        'locality': locality,
+        'postal_code': '%04d' % (ii % 500),
+        'state': state,
+        'state_code': 'S%d' % (ii % 10),
+        'country': country[0],
+        'country_code': country[1],
+        'latitude': -37.0 - (ii % 1000) / 1000.0,
+        'longitude': 144.0 + (ii % 1000) / 1000.0,
+    }
+
+def measure(func, calls):
+    """
+    Call `func` with each index in `range(calls)`, returning the mean number
+    of queries and milliseconds per call.
+    """
+    queries = [0]
+    def count(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count):
+        start = time.time()
+        for ii in range(calls):
+            func(ii)
+        elapsed = time.time() - start
+    return {'queries': queries[0] / float(calls), 'ms': elapsed * 1000.0 / calls}
+
+@case('to_python_dict_new')
+def to_python_dict_new(calls):
+    return lambda ii: to_python(make_components(ii, prefix='new-'))
+
+@case('to_python_dict_existing')
+def to_python_dict_existing(calls):
+    bulk_to_python([make_components(ii, prefix='existing-') for ii in range(calls)])
+    return lambda ii: to_python(make_components(ii, prefix='existing-'))
+
+@case('to_python_string')
+def to_python_string(calls):
+    return lambda ii: to_python('Out the back of %d Somewhere Ave' % (ii % 10))
+
+@case('to_python_pk')
+def to_python_pk(calls):
+    pk = to_python(make_components(0)).pk
+    return lambda ii: to_python(pk)
+
+@case('widget_render_pk')
+def widget_render_pk(calls):
+    from address.forms import AddressWidget
+    pks = [a.pk for a in bulk_to_python([make_components(ii, prefix='render-') for ii in range(calls)])]
+    widget = AddressWidget()
+    return lambda ii: widget.render('address', pks[ii])
+
+@case('widget_render_dict')
+def widget_render_dict(calls):
+    from address.forms import AddressWidget
+    widget = AddressWidget()
+    return lambda ii: widget.render('address', make_components(ii))
+
+@case('widget_render_formset')
+def widget_render_formset(calls):
+    from django.forms import Form, formset_factory
+    from address.forms import AddressField, prefetch_addresses
+    class AddressForm(Form):
+        address = AddressField()
+    pks = [a.pk for a in bulk_to_python([make_components(ii, prefix='formset-') for ii in range(100)])]
+    AddressFormSet = formset_factory(AddressForm, extra=0)
+
+    def render(ii):
+        formset = AddressFormSet(initial=[{'address': pk} for pk in pks])
+        prefetch_addresses(formset)
+        for form in formset:
+            form['address'].as_widget()
+    return render
+
+@case('widget_value_from_datadict')
+def widget_value_from_datadict(calls):
+    from address.forms import AddressWidget
+    widget = AddressWidget()
+    data = dict(('address_%s' % k, v) for k, v in make_components(0).items())
+    data['address'] = data.pop('address_raw')
+    return lambda ii: widget.value_from_datadict(data, {}, 'address')
+
+def formset_post(compact):
+    from django.http import QueryDict
+    from django.test.utils import override_settings
+    from address.forms import AddressWidget
+    widget = AddressWidget(compact=compact)
+    data = QueryDict(mutable=True)
+    for ii in range(100):
+        name = 'form-%d-address' % ii
+        html = widget.render(name, make_components(ii))
+        for key, value in re.findall(r'name="([^"]+)"(?: data-geo="[^"]*")? value="([^"]*)"', html):
+            data[key] = unescape(value)
+        data[name] = make_components(ii)['raw']
+    body = data.urlencode()
+
+    # Parse the body of the request, then each form's address. The separate
+    # hidden fields exceed Django's default limit on the number of fields.
+    def parse(ii):
+        with override_settings(DATA_UPLOAD_MAX_NUMBER_FIELDS=None):
+            post = QueryDict(body)
+        for jj in range(100):
+            widget.value_from_datadict(post, {}, 'form-%d-address' % jj)
+    return parse
+
+@case('widget_formset_post')
+def widget_formset_post(calls):
+    return formset_post(False)
+
+@case('widget_formset_post_compact')
+def widget_formset_post_compact(calls):
+    return formset_post(True)
+
+@case('admin_changelist')
+def admin_changelist(calls):
+    from django.contrib import admin
+    from django.contrib.admin.templatetags.admin_list import results
+    from django.contrib.auth.models import AnonymousUser
+    from django.test import RequestFactory
+    from address.admin import AddressAdmin
+    bulk_to_python([make_components(ii, prefix='admin-') for ii in range(100)])
+    request = RequestFactory().get('/')
+    request.user = AnonymousUser()
+    model_admin = AddressAdmin(Address, admin.site)
+
+    def render(ii):
+        cl = model_admin.get_changelist_instance(request)
+        cl.formset = None
+        list(results(cl))
+    return render
+
+@case('bulk_to_python', scaled=True)
+def bulk_to_python_case(size):
+    return lambda ii: bulk_to_python(make_components(jj, prefix='bulk-%d-%d-' % (size, ii)) for jj in range(size))
+
+def seed_coordinates(size):
+    """
+    Insert exactly `size` addresses spread evenly over the globe, without
+    resolving any hierarchy. The benchmark command rolls them back after
+    each measurement, so every size is measured against its own rows.
+    """
+    random = Random(size)
+    for start in range(0, size, 10000):
+        addresses = [
+            Address(raw='geo-%d' % ii, latitude=random.uniform(-85, 85), longitude=random.uniform(-180, 180))
+            for ii in range(start, min(start + 10000, size))
+        ]
+        for address in addresses:
+            address.geohash = address.get_geohash()
+        Address.objects.bulk_create(addresses)
+
+@case('within_radius', scaled=True)
+def within_radius(size):
+    seed_coordinates(size)
+    return lambda ii: list(Address.objects.within_radius(51.5, -0.1, 100))
+
+@case('nearest', scaled=True)
+def nearest(size):
+    seed_coordinates(size)
+    return lambda ii: Address.objects.nearest(51.5, -0.1, 10)
+
+@case('geohash_counts', scaled=True)
+def geohash_counts(size):
+    seed_coordinates(size)
+    return lambda ii: list(Address.objects.geohash_counts(3))
+
+def seed_search(size):
+    """
+    Make sure there are at least `size` raw-only addresses with distinct
+    display strings, inserted without resolving any hierarchy.
+    """
+    existing = Address.objects.filter(raw__startswith='search-').count()
+    for start in range(existing, size, 10000):
+        addresses = [Address(raw='search-%07d Some Street' % ii) for ii in range(start, min(start + 10000, size))]
+        for address in addresses:
+            address.display = address.get_display()
+            address.search = address.display.lower()
+        Address.objects.bulk_create(addresses)
+
+@case('autocomplete', scaled=True)
+def autocomplete(size):
+    from django.contrib.auth.models import User
+    from django.test import RequestFactory
+    from address.views import autocomplete
+    seed_search(size)
+    user = User(username='benchmark')
+    factory = RequestFactory()
+
+    def search(ii):
+        request = factory.get('/', {'q': 'search-%05d' % ((ii * 7919) % max(size // 100, 1))})
+        request.user = user
+        autocomplete(request)
+    return search
+
+def import_case(workers):
+    def setup(size):
+        from address.importer import import_rows, read_rows
+        directory = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, directory, True)
+        path = os.path.join(directory, 'import.jsonl')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for ii in range(size):
+                row = dict((k, unicode(v)) for k, v in make_components(ii, prefix='import-%d-' % workers).items())
+                f.write(unicode(json.dumps(row)) + u'\n')
+
+        # As the import command reads the file, with workers parsing lines.
+        return lambda ii: import_rows(read_rows(path, parse=workers <= 1), batch_size=1000, workers=workers)
+    return setup
+
+for workers in (1, 4, 8):
+    case('import_rows_%d_workers' % workers, scaled=True)(import_case(workers))
+
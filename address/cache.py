@@ -0,0 +1,218 @@
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+__all__ = ['HierarchyCache', 'SharedHierarchyCache', 'get_cache', 'get_shared_cache', 'get_caches',
+           'natural_key']
+
+##
+## The natural key each hierarchy model is looked up by in `_to_python`.
+##
+def natural_key(obj):
+    name = obj._meta.model_name
+    if name == 'country':
+        return (name, obj.name)
+    elif name == 'state':
+        return (name, obj.name, obj.country_id)
+    elif name == 'locality':
+        return (name, obj.name, obj.postal_code, obj.state_id)
+    raise TypeError('No natural key for %r' % obj)
+
+##
+## Both tiers keep only the field values of a row and build a fresh instance
+## on each hit, so no related objects cached on it can go stale, and callers
+## can't change what's cached.
+##
+def _clock():
+    # Microseconds, so a reseeded version is past any reached by incrementing.
+    return int(time.time() * 1000000)
+
+def _values(obj):
+    return dict((f.attname, getattr(obj, f.attname)) for f in obj._meta.concrete_fields)
+
+def _build(model, values):
+    names = [f.attname for f in model._meta.concrete_fields]
+    return model.from_db(DEFAULT_DB_ALIAS, names, [values[n] for n in names])
+
+##
+## A bounded, thread safe LRU cache of Country, State and Locality instances
+## keyed on their natural keys. Entries older than `ttl` seconds are ignored.
+##
+## Rows are read from the database between taking a `stamp` and calling
+## `set`, and `set` is skipped if any row of the model was evicted meanwhile,
+## so values read before a change can't be cached after it.
+##
+class HierarchyCache(object):
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def stamp(self, key):
+        return self._generations.get(key[0], 0)
+
+    def get(self, key, stamp=None):
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                return None
+            self._entries[key] = entry
+        return _build(entry[1], entry[2])
+
+    def set(self, obj, stamp=None):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if stamp is not None and stamp != self.stamp(natural_key(obj)):
+                return
+            self._entries.pop(natural_key(obj), None)
+            self._entries[natural_key(obj)] = (expires, type(obj), _values(obj))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def set_on_commit(self, obj):
+        # Newly created rows may yet be rolled back, so only remember them
+        # once they are visible to everyone else.
+        stamp = self.stamp(natural_key(obj))
+        transaction.on_commit(lambda: self.set(obj, stamp))
+
+    def evict(self, obj):
+        # Scan rather than use the natural key, so that renamed rows are
+        # removed under their old key too.
+        name = obj._meta.model_name
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+            for key, (expires, model, values) in list(self._entries.items()):
+                if key[0] == name and values[obj._meta.pk.attname] == obj.pk:
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for name in list(self._generations):
+                self._generations[name] += 1
+
+##
+## A tier backed by Django's cache framework, shared between processes. Only
+## the field values of each row are stored, under keys that include a per
+## model version which is bumped whenever any row of that model changes.
+## Rows read from the database are stored under the version taken before
+## reading them, so a change made meanwhile leaves them unreachable. A lost
+## version is seeded again from the clock rather than from 1, so it never
+## returns to a version used before.
+##
+class SharedHierarchyCache(object):
+
+    def __init__(self, alias=DEFAULT_CACHE_ALIAS, ttl=DEFAULT_TIMEOUT):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def _version_key(self, name):
+        return 'address:%s:version' % name
+
+    def _key(self, key, version):
+        digest = hashlib.md5(json.dumps(key).encode('utf-8')).hexdigest()
+        return 'address:%s:%s:%s' % (key[0], version, digest)
+
+    def _version(self, name):
+        version_key = self._version_key(name)
+        version = self.backend.get(version_key)
+        if version is None:
+            seed = _clock()
+            self.backend.add(version_key, seed, None)
+            version = self.backend.get(version_key, seed)
+        return version
+
+    def stamp(self, key):
+        return self._version(key[0])
+
+    def get(self, key, stamp=None):
+        from django.apps import apps
+        version = stamp if stamp is not None else self._version(key[0])
+        values = self.backend.get(self._key(key, version))
+        if values is None:
+            return None
+        return _build(apps.get_model('address', key[0]), values)
+
+    def set(self, obj, stamp=None):
+        key = natural_key(obj)
+        version = stamp if stamp is not None else self._version(key[0])
+        self.backend.set(self._key(key, version), _values(obj), self.ttl)
+
+    def set_on_commit(self, obj):
+        stamp = self.stamp(natural_key(obj))
+        transaction.on_commit(lambda: self.set(obj, stamp))
+
+    def evict(self, obj):
+        version_key = self._version_key(obj._meta.model_name)
+        try:
+            self.backend.incr(version_key)
+        except ValueError:
+            if not self.backend.add(version_key, _clock(), None):
+                self.backend.incr(version_key)
+
+    def clear(self):
+        for name in ('country', 'state', 'locality'):
+            self.backend.delete(self._version_key(name))
+
+_cache = None
+
+def get_cache():
+    """
+    Return the process-local hierarchy cache, or `None` if it is disabled.
+    It is configured by the `ADDRESS_CACHE_SIZE` and `ADDRESS_CACHE_TTL`
+    settings and is disabled by default.
+    """
+    global _cache
+    size = getattr(settings, 'ADDRESS_CACHE_SIZE', 0)
+    ttl = getattr(settings, 'ADDRESS_CACHE_TTL', None)
+    if not size:
+        return None
+    if _cache is None or (_cache.size, _cache.ttl) != (size, ttl):
+        _cache = HierarchyCache(size, ttl)
+    return _cache
+
+def get_shared_cache():
+    """
+    Return the shared hierarchy cache, or `None` if it is disabled. It uses
+    the cache named by the `ADDRESS_CACHE_ALIAS` setting, and is disabled
+    by default.
+    """
+    alias = getattr(settings, 'ADDRESS_CACHE_ALIAS', None)
+    if not alias:
+        return None
+    return SharedHierarchyCache(alias, getattr(settings, 'ADDRESS_CACHE_TTL', DEFAULT_TIMEOUT))
+
+def get_caches():
+    """
+    Return the enabled cache tiers, fastest first.
+    """
+    return [c for c in (get_cache(), get_shared_cache()) if c is not None]
+
+def reset_cache(setting=None, **kwargs):
+    global _cache
+    if setting is None or setting.startswith('ADDRESS_CACHE'):
+        _cache = None
+
+def invalidate(sender, instance, **kwargs):
+    if _cache is not None:
+        _cache.evict(instance)
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.evict(instance)
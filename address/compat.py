@@ -13,3 +13,57 @@ def compat_contribute_to_class(self, cls, name, virtual_only=False):
     else:
         super(ForeignObject, self).contribute_to_class(
             cls, name, virtual_only=virtual_only)
+
+
+def compat_can_return_bulk_ids(connection):
+    # Renamed in Django 3.0.
+    features = connection.features
+    return (getattr(features, 'can_return_rows_from_bulk_insert', False) or
+            getattr(features, 'can_return_ids_from_bulk_insert', False))
+
+
+def compat_bulk_create_ignore_conflicts(model, objs):
+    from django.db import IntegrityError, connection, transaction
+    if getattr(connection.features, 'supports_ignore_conflicts', False):
+        model.objects.bulk_create(objs, ignore_conflicts=True)
+        return
+    # Older versions of Django can't skip conflicting rows, so fall back to
+    # inserting one at a time when the batch collides with another writer.
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(objs)
+    except IntegrityError:
+        for obj in objs:
+            obj.pk = None
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=True)
+            except IntegrityError:
+                pass
+
+
+def compat_startswith(connection, field, prefix):
+    from django.db.models import Q
+    lookup = Q(**{field + '__startswith': prefix})
+    # SQLite only uses an index for LIKE under case insensitive collations, but
+    # under its default binary collation a range matches the same rows.
+    if connection.vendor == 'sqlite' and prefix:
+        try:
+            upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        except NameError:
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        except ValueError:
+            upper = None
+        lookup &= Q(**{field + '__gte': prefix})
+        if upper is not None:
+            lookup &= Q(**{field + '__lt': upper})
+    return lookup
+
+
+def compat_bulk_update(model, objs, fields):
+    if hasattr(model.objects, 'bulk_update'):
+        model.objects.bulk_update(objs, fields)
+        return
+    # Added in Django 2.2.
+    for obj in objs:
+        obj.save(update_fields=fields)
@@ -0,0 +1,68 @@
+"""
+Stream addresses out of the database with constant memory. The hierarchy is
+joined in SQL and rows are read in chunks as plain dictionaries, using
+server-side cursors where the database supports them.
+"""
+from collections import OrderedDict
+import csv
+import json
+
+from django.db import models
+
+from address.models import Address
+
+__all__ = ['EXPORT_FIELDS', 'iter_addresses', 'write_csv', 'write_jsonl']
+
+# Exported names of each column, mapped to their lookups from `Address`.
+EXPORT_FIELDS = OrderedDict([
+    ('id', 'pk'),
+    ('raw', 'raw'),
+    ('formatted', 'formatted'),
+    ('street_number', 'street_number'),
+    ('route', 'route'),
+    ('locality', 'locality__name'),
+    ('postal_code', 'locality__postal_code'),
+    ('state', 'locality__state__name'),
+    ('state_code', 'locality__state__code'),
+    ('country', 'locality__state__country__name'),
+    ('country_code', 'locality__state__country__code'),
+    ('latitude', 'latitude'),
+    ('longitude', 'longitude'),
+])
+
+def iter_addresses(queryset=None, country=None, state=None, chunk_size=2000):
+    """
+    Yield a dictionary of components per address, in primary key order.
+    Addresses may be limited to those in a country or a state, each given by
+    name or code.
+    """
+    if queryset is None:
+        queryset = Address.objects.all()
+    if country:
+        queryset = queryset.filter(
+            models.Q(locality__state__country__name=country) | models.Q(locality__state__country__code=country)
+        )
+    if state:
+        queryset = queryset.filter(
+            models.Q(locality__state__name=state) | models.Q(locality__state__code=state)
+        )
+    names = list(EXPORT_FIELDS.keys())
+    rows = queryset.order_by('pk').values_list(*EXPORT_FIELDS.values())
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield dict(zip(names, row))
+
+def write_csv(addresses, stream):
+    writer = csv.DictWriter(stream, fieldnames=list(EXPORT_FIELDS.keys()))
+    writer.writeheader()
+    count = 0
+    for address in addresses:
+        writer.writerow(address)
+        count += 1
+    return count
+
+def write_jsonl(addresses, stream):
+    count = 0
+    for address in addresses:
+        stream.write(json.dumps(address, sort_keys=True) + '\n')
+        count += 1
+    return count
@@ -1,9 +1,11 @@
 from django import forms
 # from uni_form.helpers import *
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from .models import Address, to_python
+from .models import Address, clean_coordinates, to_python
+import json
 import logging
 
 # Python 3 fixes.
@@ -16,11 +18,36 @@ if sys.version > '3':
 
 logger = logging.getLogger(__name__)
 
-__all__ = ['AddressWidget', 'AddressField']
+__all__ = ['AddressWidget', 'AddressField', 'prefetch_addresses']
 
 if not settings.GOOGLE_API_KEY:
     raise ImproperlyConfigured("GOOGLE_API_KEY is not configured in settings.py")
 
+_templates = {}
+
+# The translation `django.utils.html.escape` makes, without its per call
+# overhead.
+_escapes = {ord('&'): u'&amp;', ord('<'): u'&lt;', ord('>'): u'&gt;', ord('"'): u'&quot;', ord("'"): u'&#39;'}
+
+def _escape(value):
+    return (value if isinstance(value, unicode) else unicode(value)).translate(_escapes)
+
+def _compile(components):
+    # Build the markup of the hidden fields once per set of components, with
+    # slots for the field name and the escaped value of each component.
+    try:
+        return _templates[components]
+    except KeyError:
+        pass
+    parts = [u'<div id="{name}_components">']
+    for ii, (component, geo) in enumerate(components):
+        parts.append(u'<input type="hidden" name="{name}_%s" data-geo="%s" value="{%d}" />' % (
+            escape(component), escape(geo), ii
+        ))
+    parts.append(u'</div>')
+    template = _templates[components] = u'\n'.join(parts)
+    return template
+
 
 class AddressWidget(forms.TextInput):
     components = [('country', 'country'), ('country_code', 'country_short'),
@@ -39,10 +66,16 @@ class AddressWidget(forms.TextInput):
             'address/js/address.js')
 
     def __init__(self, *args, **kwargs):
+        autocomplete_url = kwargs.pop('autocomplete_url', getattr(settings, 'ADDRESS_AUTOCOMPLETE_URL', None))
+        self.compact = kwargs.pop('compact', getattr(settings, 'ADDRESS_WIDGET_COMPACT', False))
         attrs = kwargs.get('attrs', {})
         classes = attrs.get('class', '')
         classes += (' ' if classes else '') + 'address'
         attrs['class'] = classes
+
+        # Suggest stored addresses before asking Google.
+        if autocomplete_url:
+            attrs['data-autocomplete-url'] = autocomplete_url
         kwargs['attrs'] = attrs
         super(AddressWidget, self).__init__(*args, **kwargs)
 
@@ -54,7 +87,7 @@ class AddressWidget(forms.TextInput):
         elif isinstance(value, dict):
             ad = value
         elif isinstance(value, (int, long)):
-            ad = Address.objects.get(pk=value)
+            ad = Address.objects.with_hierarchy().get(pk=value)
             ad = ad.as_dict()
         else:
             ad = value.as_dict()
@@ -62,26 +95,55 @@ class AddressWidget(forms.TextInput):
         # Generate the elements. We should create a suite of hidden fields
         # For each individual component, and a visible field for the raw
         # input. Begin by generating the raw input.
-        elems = [super(AddressWidget, self).render(name, ad.get('formatted', None), attrs, **kwargs)]
+        elems = super(AddressWidget, self).render(name, ad.get('formatted', None), attrs, **kwargs)
 
-        # Now add the hidden fields.
-        elems.append('<div id="%s_components">' % name)
-        for com in self.components:
-            elems.append('<input type="hidden" name="%s_%s" data-geo="%s" value="%s" />' % (
-                name, com[0], com[1], ad.get(com[0], ''))
+        # In compact mode the components travel as a single JSON object.
+        if self.compact:
+            payload = dict([(c[0], ad[c[0]]) for c in self.components if ad.get(c[0]) not in (None, '')])
+            hidden = u'<input type="hidden" name="%s_components" value="%s" />' % (
+                _escape(name), _escape(json.dumps(payload, separators=(',', ':'), default=unicode))
             )
-        elems.append('</div>')
+            return mark_safe(elems + u'\n' + hidden)
 
-        return mark_safe(unicode('\n'.join(elems)))
+        # Otherwise add the hidden fields, escaping their values.
+        hidden = _compile(tuple(self.components)).format(
+            *[_escape(ad.get(com[0], '')) for com in self.components], name=_escape(name)
+        )
+        return mark_safe(elems + u'\n' + hidden)
 
     def value_from_datadict(self, data, files, name):
         raw = data.get(name, '')
         if not raw:
             return raw
-        ad = dict([(c[0], data.get(name + '_' + c[0], '')) for c in self.components])
+        if self.compact:
+            ad = self.parse_components(data.get(name + '_components', ''))
+        else:
+            ad = dict([(c[0], data.get(name + '_' + c[0], '')) for c in self.components])
         ad['raw'] = raw
         return ad
 
+    def parse_components(self, payload):
+        """
+        Parse the JSON object of a compact widget into the same dictionary of
+        strings the separate hidden fields give, for `AddressField` to validate
+        as usual. A malformed payload leaves just the raw value.
+        """
+        try:
+            values = json.loads(payload) if payload else {}
+        except ValueError:
+            values = None
+        if not isinstance(values, dict):
+            logger.warning('Ignoring malformed address components %r', payload[:100])
+            values = {}
+        ad = {}
+        for component, geo in self.components:
+            value = values.get(component)
+            if isinstance(value, (basestring, int, long, float)):
+                ad[component] = value if isinstance(value, basestring) else unicode(value)
+            else:
+                ad[component] = ''
+        return ad
+
 
 class AddressField(forms.ModelChoiceField):
     widget = AddressWidget
@@ -90,6 +152,14 @@ class AddressField(forms.ModelChoiceField):
         kwargs['queryset'] = Address.objects.none()
         super(AddressField, self).__init__(*args, **kwargs)
 
+    def prepare_value(self, value):
+
+        # Hand address objects to the widget as they are, rather than their
+        # primary keys, so it doesn't need to fetch them again.
+        if isinstance(value, Address):
+            return value
+        return super(AddressField, self).prepare_value(value)
+
     def to_python(self, value):
 
         # Treat `None`s and empty strings as empty.
@@ -97,15 +167,38 @@ class AddressField(forms.ModelChoiceField):
             return None
 
         # Check for garbage in the lat/lng components.
-        for field in ['latitude', 'longitude']:
-            if field in value:
-                if value[field]:
-                    try:
-                        value[field] = float(value[field])
-                    except:
-                        raise forms.ValidationError('Invalid value for %(field)s', code='invalid',
-                                                    params={'field': field})
-                else:
-                    value[field] = None
+        clean_coordinates(value)
 
         return to_python(value)
+
+
+def prefetch_addresses(form_list):
+    """
+    Load the initial addresses of every `AddressField` in a form, a formset or
+    a list of forms with a single query, so that rendering them doesn't query
+    each address and its locality, state and country separately.
+    """
+    if isinstance(form_list, forms.BaseForm):
+        form_list = [form_list]
+    elif isinstance(form_list, forms.BaseFormSet):
+        form_list = form_list.forms
+
+    # Find the initial values needing to be loaded.
+    pending = []
+    for form in form_list:
+        for name, field in form.fields.items():
+            if not isinstance(field, AddressField):
+                continue
+            value = form.get_initial_for_field(field, name)
+            if isinstance(value, Address):
+                if value.locality_id is None:
+                    continue
+                value = value.pk
+            if isinstance(value, (int, long)):
+                pending.append((form, name, value))
+
+    addresses = Address.objects.with_hierarchy().in_bulk(set(p[2] for p in pending))
+    for form, name, pk in pending:
+        if pk in addresses:
+            form.initial[name] = addresses[pk]
+
@@ -0,0 +1,247 @@
+"""
+Server side geocoding of raw address strings into the component dictionaries
+`address.models.to_python` resolves. A geocoder is configured with the
+`ADDRESS_GEOCODER` setting, a dotted path to a class or factory taking no
+arguments. Without one, strings are stored as raw-only addresses.
+
+A geocoder is any object with a `geocode(raw)` method returning a dictionary
+of components, or `None` when the string can't be resolved.
+"""
+from datetime import timedelta
+import hashlib
+import json
+import logging
+import re
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from address import metrics
+from address.models import GeocodeResult, Locality, _normalize, search_key
+
+try:
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+except ImportError:
+    from urllib import urlencode
+    from urllib2 import urlopen
+
+__all__ = ['GeocodeError', 'LocalGeocoder', 'HTTPGeocoder', 'GoogleGeocoder', 'get_geocoder', 'geocode']
+
+logger = logging.getLogger(__name__)
+
+class GeocodeError(Exception):
+    pass
+
+def _components(raw, street='', locality_obj=None, **kwargs):
+    components = dict(
+        raw=raw, street_number='', route='', locality='', postal_code='', state='', state_code='',
+        country='', country_code='', formatted='', latitude=None, longitude=None,
+    )
+    match = re.match(r'^(\d\S*)\s+(.+)$', street.strip())
+    if match:
+        components['street_number'], components['route'] = match.groups()
+    else:
+        components['route'] = street.strip()
+    if locality_obj is not None:
+        state_obj = locality_obj.state
+        components.update(
+            locality=locality_obj.name, postal_code=locality_obj.postal_code,
+            state=state_obj.name, state_code=state_obj.code,
+            country=state_obj.country.name, country_code=state_obj.country.code,
+        )
+    components.update(kwargs)
+    return components
+
+##
+## A gazetteer built from the localities already stored. Every run of words
+## within each comma separated part of the string is looked up as a locality
+## name in a single query, and the best match wins by postal code, state and
+## country. Whatever precedes the locality is taken to be the street.
+##
+class LocalGeocoder(object):
+    max_candidates = 100
+
+    # Searching the localities is as quick as the cache, and always current.
+    cacheable = False
+
+    def geocode(self, raw):
+        parts = [p.split() for p in raw.split(',')]
+        names = {}
+        for ii, words in enumerate(parts):
+            for start in range(len(words)):
+                for end in range(start + 1, len(words) + 1):
+                    names.setdefault(search_key(' '.join(words[start:end])), (ii, start))
+        if not names:
+            return None
+
+        text = ' %s ' % _normalize(raw)
+        def mentions(value):
+            return bool(value) and (' %s ' % _normalize(value)) in text
+
+        best, best_score, tied = None, 0, False
+        candidates = Locality.objects.with_hierarchy().filter(search__in=list(names))
+        for locality in candidates.order_by('pk')[:self.max_candidates]:
+            state, country = locality.state, locality.state.country
+            score = (4 + 2 * mentions(locality.postal_code) +
+                     (mentions(state.name) or mentions(state.code)) +
+                     (mentions(country.name) or mentions(country.code)))
+            if score > best_score:
+                best, best_score, tied = locality, score, False
+            elif score == best_score:
+                tied = True
+        if best is None or tied:
+            return None
+
+        # The street is what precedes the locality in its part, or else the
+        # previous part.
+        ii, start = names[best.search]
+        street = ' '.join(parts[ii][:start]) or (' '.join(parts[ii - 1]) if ii else '')
+        return _components(raw, street, best)
+
+##
+## A base for geocoding web services. Subclasses give the parameters of a
+## request and parse its JSON response. Results, including failures to
+## resolve, are kept in Django's cache so each string is only sent once.
+##
+class HTTPGeocoder(object):
+    url = None
+    timeout = 5
+
+    def __init__(self, cache_alias=DEFAULT_CACHE_ALIAS, ttl=30 * 24 * 60 * 60):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+
+    def geocode(self, raw):
+        cache = caches[self.cache_alias]
+        key = 'address:geocode:%s:%s' % (
+            type(self).__name__, hashlib.md5(_normalize(raw).encode('utf-8')).hexdigest()
+        )
+        result = cache.get(key)
+        if result is None:
+            result = self.parse(raw, self.fetch(raw)) or {}
+            cache.set(key, result, self.ttl)
+        return dict(result, raw=raw) if result else None
+
+    def fetch(self, raw):
+        try:
+            response = urlopen('%s?%s' % (self.url, urlencode(self.params(raw))), timeout=self.timeout)
+            try:
+                return json.loads(response.read().decode('utf-8'))
+            finally:
+                response.close()
+        except (IOError, ValueError) as e:
+            raise GeocodeError(e)
+
+    def params(self, raw):
+        raise NotImplementedError
+
+    def parse(self, raw, data):
+        raise NotImplementedError
+
+##
+## Google's geocoding API, using the `GOOGLE_API_KEY` setting the widget
+## already needs.
+##
+class GoogleGeocoder(HTTPGeocoder):
+    url = 'https://maps.googleapis.com/maps/api/geocode/json'
+
+    def params(self, raw):
+        return {'address': raw.encode('utf-8'), 'key': settings.GOOGLE_API_KEY}
+
+    def parse(self, raw, data):
+        status = data.get('status')
+        if status == 'ZERO_RESULTS':
+            return None
+        elif status != 'OK':
+            raise GeocodeError('%s: %s' % (status, data.get('error_message', '')))
+        result = data['results'][0]
+        names = {}
+        for component in result.get('address_components', []):
+            for kind in component.get('types', []):
+                names.setdefault(kind, (component['long_name'], component['short_name']))
+        location = result.get('geometry', {}).get('location', {})
+        empty = ('', '')
+        return _components(
+            raw,
+            street_number=names.get('street_number', empty)[0],
+            route=names.get('route', empty)[0],
+            locality=names.get('locality', names.get('sublocality', empty))[0],
+            postal_code=names.get('postal_code', empty)[0],
+            state=names.get('administrative_area_level_1', empty)[0],
+            state_code=names.get('administrative_area_level_1', empty)[1],
+            country=names.get('country', empty)[0],
+            country_code=names.get('country', empty)[1],
+            formatted=result.get('formatted_address', ''),
+            latitude=location.get('lat'),
+            longitude=location.get('lng'),
+        )
+
+_UNSET = object()
+_geocoder = _UNSET
+
+def get_geocoder():
+    """
+    Return the configured geocoder, or `None` if geocoding is disabled.
+    """
+    global _geocoder
+    if _geocoder is _UNSET:
+        path = getattr(settings, 'ADDRESS_GEOCODER', None)
+        _geocoder = import_string(path)() if path else None
+    return _geocoder
+
+def reset_geocoder(setting=None, **kwargs):
+    global _geocoder
+    if setting is None or setting == 'ADDRESS_GEOCODER':
+        _geocoder = _UNSET
+
+def _cache_ttl():
+    return getattr(settings, 'ADDRESS_GEOCODE_CACHE_TTL', 30 * 24 * 60 * 60)
+
+def _cached(raw, key):
+    ttl = _cache_ttl()
+    result = GeocodeResult.objects.filter(key=key).first()
+    if result is None:
+        metrics.incr('geocode.cache.miss')
+        return _UNSET
+    if ttl is not None and result.created < timezone.now() - timedelta(seconds=ttl):
+        metrics.incr('geocode.cache.expired')
+        return _UNSET
+    metrics.incr('geocode.cache.hit')
+    components = json.loads(result.components) if result.components else None
+    return dict(components, raw=raw) if components else None
+
+def geocode(raw, geocoder=None):
+    """
+    Geocode a raw string with the given or configured geocoder, returning a
+    dictionary of components or `None`. Results are kept in the
+    `GeocodeResult` table for `ADDRESS_GEOCODE_CACHE_TTL` seconds, unless the
+    geocoder sets `cacheable` to false. Errors are logged rather than raised,
+    so an unavailable service leaves the address raw.
+    """
+    if geocoder is None:
+        geocoder = get_geocoder()
+    if geocoder is None:
+        return None
+    cacheable = getattr(geocoder, 'cacheable', True) and _cache_ttl() != 0
+    if cacheable:
+        key = GeocodeResult.make_key(geocoder, raw)
+        components = _cached(raw, key)
+        if components is not _UNSET:
+            return components
+    with metrics.timed('geocode'):
+        try:
+            components = geocoder.geocode(raw)
+        except GeocodeError as e:
+            logger.warning('Unable to geocode %r: %s', raw, e)
+            metrics.incr('geocode.error')
+            return None
+    metrics.incr('geocode.resolved' if components else 'geocode.unresolved')
+    if cacheable:
+        GeocodeResult.objects.update_or_create(key=key, defaults={
+            'components': json.dumps(components) if components else '',
+            'created': timezone.now(),
+        })
+    return components
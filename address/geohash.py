@@ -0,0 +1,37 @@
+"""
+Geohash encoding, a hierarchical grid key where each additional character
+subdivides a cell into 32. Addresses sharing a prefix lie in the same cell.
+"""
+
+__all__ = ['encode', 'MAX_PRECISION']
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+MAX_PRECISION = 12
+
+def encode(latitude, longitude, precision=MAX_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            rng, value = lng_range, longitude
+        else:
+            rng, value = lat_range, latitude
+        mid = (rng[0] + rng[1]) / 2.0
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
@@ -0,0 +1,193 @@
+"""
+Stream addresses into the database from CSV or JSON Lines files, resolving
+their hierarchy in batches.
+"""
+from multiprocessing import Pool, cpu_count
+import csv
+import io
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+
+from address.models import (Address, Country, InconsistentDictError, Locality, State, bulk_to_python,
+                            clean_coordinates, prepare_components, to_python)
+
+# Python 3 fixes.
+import sys
+
+if sys.version > '3':
+    basestring = (str, bytes)
+    unicode = str
+
+__all__ = ['Line', 'MalformedLine', 'read_rows', 'parse_line', 'clean_row', 'prepare_row', 'import_rows']
+
+# The column each component is stored in, to reject values too long for it.
+COLUMNS = [
+    ('raw', Address, 'raw'), ('formatted', Address, 'formatted'),
+    ('street_number', Address, 'street_number'), ('route', Address, 'route'),
+    ('locality', Locality, 'name'), ('sublocality', Locality, 'name'),
+    ('postal_code', Locality, 'postal_code'), ('state', State, 'name'), ('country', Country, 'name'),
+]
+
+class Line(unicode):
+    """
+    A line of a JSON Lines file yet to be parsed, which is cheaper to send to
+    a worker process than the row it holds.
+    """
+
+class MalformedLine(unicode):
+    """
+    A line of a JSON Lines file that couldn't be decoded, yielded by
+    `read_rows` in place of a row so that it is rejected rather than ending
+    the import.
+    """
+    error = None
+
+def read_rows(path, format=None, parse=True):
+    """
+    Yield each row of a CSV or JSON Lines file as a dictionary. The format is
+    guessed from the file extension if not given. Without `parse`, lines of
+    JSON Lines files are yielded as they are, for `prepare_row` to parse.
+    """
+    if format is None:
+        format = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+    with io.open(path, encoding='utf-8', newline='' if format == 'csv' else None) as stream:
+        if format == 'csv':
+            for row in csv.DictReader(stream):
+                yield row
+        else:
+            for line in stream:
+                if line.strip():
+                    line = Line(line.rstrip('\r\n'))
+                    yield parse_line(line) if parse else line
+
+def parse_line(line):
+    """
+    Parse a line of a JSON Lines file, returning a `MalformedLine` if it
+    isn't valid JSON.
+    """
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        line = MalformedLine(line)
+        line.error = unicode(e)
+        return line
+
+def clean_row(row):
+    """
+    Validate a row the same way `address.forms.AddressField` does, returning
+    the component dictionary to resolve.
+    """
+    if isinstance(row, MalformedLine):
+        raise ValidationError('Invalid JSON: %(error)s', params={'error': row.error})
+    if not isinstance(row, dict):
+        raise ValidationError('Invalid address value.')
+    value = dict((k, v if v is not None else '') for k, v in row.items())
+    clean_coordinates(value)
+    if not value.get('raw'):
+        raise ValidationError('Addresses may not have a blank `raw` field.')
+    for component, model, name in COLUMNS:
+        length = model._meta.get_field(name).max_length
+        if isinstance(value.get(component), basestring) and len(value[component]) > length:
+            raise ValidationError('Invalid value for %(field)s (longer than %(length)d characters)',
+                                  params={'field': component, 'length': length})
+    return value
+
+def prepare_row(row):
+    """
+    Parse, validate and normalize a row without touching the database,
+    returning the row, its prepared components and any error. Rows with an
+    inconsistent hierarchy are kept as they are, to be stored raw. Rows given
+    as a `Line` are returned as the line unless rejected.
+    """
+    line = row if isinstance(row, Line) else None
+    if line is not None:
+        row = parse_line(line)
+    try:
+        value = clean_row(row)
+        components = prepare_components(value)
+    except ValidationError as e:
+        return row, None, e
+    except InconsistentDictError:
+        return line or row, value, None
+    except ValueError as e:
+        return row, None, e
+    return line or row, components, None
+
+def _init_worker():
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
+
+def import_rows(rows, batch_size=1000, on_reject=None, on_batch=None, workers=1):
+    """
+    Resolve rows into addresses a batch at a time, each batch in its own
+    transaction. Rows failing validation are passed to `on_reject` with the
+    error, and `on_batch` is called with the number of rows consumed so far
+    after each batch commits. Returns the number of addresses imported.
+
+    With more than one worker, rows are parsed, validated and normalized in a
+    pool of processes while this one resolves them, in the same order as
+    read. Pass them the unparsed lines of `read_rows(path, parse=False)`.
+    Workers beyond the number of CPUs would only add overhead, so there are
+    never more than that.
+    """
+    workers = min(workers, cpu_count())
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_worker)
+        try:
+            prepared = pool.imap(prepare_row, rows, chunksize=max(1, min(500, batch_size // workers)))
+            return _import_prepared(prepared, batch_size, on_reject, on_batch)
+        finally:
+            pool.terminate()
+            pool.join()
+    return _import_prepared((prepare_row(row) for row in rows), batch_size, on_reject, on_batch)
+
+def _import_prepared(prepared, batch_size, on_reject, on_batch):
+    imported = 0
+    consumed = 0
+    batch = []
+
+    def reject(row, error):
+        if on_reject is not None:
+            on_reject(parse_line(row) if isinstance(row, Line) else row, error)
+
+    def flush():
+        try:
+            with transaction.atomic():
+                bulk_to_python([v for r, v in batch])
+            return len(batch)
+        except (ValueError, DatabaseError):
+            pass
+
+        # Something in the batch is invalid, so resolve one at a time to find it.
+        count = 0
+        with transaction.atomic():
+            for row, value in batch:
+                try:
+                    with transaction.atomic():
+                        to_python(value)
+                    count += 1
+                except (ValueError, DatabaseError) as e:
+                    reject(row, e)
+        return count
+
+    for row, value, error in prepared:
+        consumed += 1
+        if error is not None:
+            reject(row, error)
+        else:
+            batch.append((row, value))
+        if consumed % batch_size == 0:
+            if batch:
+                imported += flush()
+                batch = []
+            if on_batch is not None:
+                on_batch(consumed)
+    if batch:
+        imported += flush()
+    if on_batch is not None and consumed % batch_size:
+        on_batch(consumed)
+    return imported
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from address.compat import compat_bulk_update
+from address.models import Address
+
+
+class Command(BaseCommand):
+    help = 'Fill in the geohash of addresses with a latitude and longitude but no geohash, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of addresses to update per transaction.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches.')
+
+    def handle(self, *args, **options):
+        last_pk = 0
+        filled = 0
+        qs = Address.objects.filter(geohash='', latitude__isnull=False, longitude__isnull=False)
+        while True:
+            batch = list(qs.filter(pk__gt=last_pk).order_by('pk')
+                         .only('pk', 'latitude', 'longitude')[:options['batch_size']])
+            if not batch:
+                break
+            for address in batch:
+                address.geohash = address.get_geohash()
+            with transaction.atomic():
+                compat_bulk_update(Address, batch, ['geohash'])
+            last_pk = batch[-1].pk
+            filled += len(batch)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write('Geohashed %d addresses.' % filled)
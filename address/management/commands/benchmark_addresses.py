@@ -0,0 +1,112 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.urls import NoReverseMatch
+
+from address.benchmarks import CASES, SCALED_CASES, measure
+from address.cache import get_caches
+
+BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'benchmarks', 'baseline.json')
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Measure queries and wall time per call of the address resolution path, and compare them with '
+            'stored baselines. Each case runs in its own savepoint, which is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=100,
+                            help='Number of calls to average each case over.')
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='Row counts for the bulk cases.')
+        parser.add_argument('--cases', nargs='+',
+                            help='Only run these cases.')
+        parser.add_argument('--baseline', default=BASELINE,
+                            help='JSON file of baselines, keyed by database vendor.')
+        parser.add_argument('--update-baseline', action='store_true',
+                            help='Store these results as the new baseline.')
+        parser.add_argument('--tolerance', type=float, default=2.0,
+                            help='Fail when a case is this many times slower than its baseline.')
+
+    def handle(self, *args, **options):
+        results = {}
+        try:
+            with transaction.atomic():
+                self.run(options, results)
+                raise Rollback
+        except Rollback:
+            pass
+
+        try:
+            with open(options['baseline']) as f:
+                baselines = json.load(f)
+        except (IOError, ValueError):
+            baselines = {}
+        baseline = baselines.get(connection.vendor, {})
+
+        failures = []
+        for name, result in sorted(results.items()):
+            expected = baseline.get(name)
+            line = '%-40s %8.2f queries %10.3f ms' % (name, result['queries'], result['ms'])
+            if expected is not None:
+                if result['queries'] > expected['queries'] + 0.01:
+                    failures.append('%s: %.2f queries, baseline %.2f' % (name, result['queries'], expected['queries']))
+                # Allow a millisecond of noise for the quickest cases.
+                if result['ms'] > max(expected['ms'] * options['tolerance'], expected['ms'] + 1.0):
+                    failures.append('%s: %.3f ms, baseline %.3f' % (name, result['ms'], expected['ms']))
+                line += '   (baseline %.2f queries %.3f ms)' % (expected['queries'], expected['ms'])
+            self.stdout.write(line)
+
+        if options['update_baseline']:
+            for name, result in results.items():
+                baseline[name] = {'queries': round(result['queries'], 2), 'ms': round(result['ms'], 3)}
+            baselines[connection.vendor] = baseline
+            with open(options['baseline'], 'w') as f:
+                json.dump(baselines, f, indent=2, sort_keys=True)
+                f.write('\n')
+            self.stdout.write('Baseline written to %s.' % options['baseline'])
+        elif failures:
+            raise CommandError('Regressions found:\n  ' + '\n  '.join(failures))
+
+    def run(self, options, results):
+        calls = options['calls']
+        selected = options['cases']
+        for name, setup in CASES.items():
+            if selected and name not in selected:
+                continue
+            try:
+                results[name] = self.measure(setup, calls, calls)
+            except NoReverseMatch:
+                self.stderr.write('Skipping %s, the admin is not in the URLconf.' % name)
+        for name, setup in SCALED_CASES.items():
+            if selected and name not in selected:
+                continue
+            for size in options['sizes']:
+                results['%s[%d]' % (name, size)] = self.measure(setup, size, 1)
+
+    def measure(self, setup, arg, calls):
+        """
+        Set up and measure a case in a savepoint that is rolled back, with
+        empty hierarchy caches, so that no case sees the rows of another and
+        results don't depend on which cases run or in what order.
+        """
+        result = []
+        try:
+            with transaction.atomic():
+                self.clear_caches()
+                result.append(measure(setup(arg), calls))
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            self.clear_caches()
+        return result[0]
+
+    def clear_caches(self):
+        for cache in get_caches():
+            cache.clear()
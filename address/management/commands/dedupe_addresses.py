@@ -0,0 +1,126 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from address.compat import compat_bulk_update
+from address.models import Address
+
+
+class Command(BaseCommand):
+    help = ('Fill in missing address fingerprints, then merge addresses sharing a fingerprint into the oldest '
+            'one, repointing foreign keys (including AddressFields), one-to-one and many-to-many links to it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of addresses to fingerprint per transaction.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report duplicates without writing anything. Addresses without a fingerprint '
+                                 'are not filled in, and so not checked.')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            unchecked = Address.objects.filter(fingerprint='').count()
+            if unchecked:
+                self.stdout.write('Not checking %d addresses without a fingerprint.' % unchecked)
+        else:
+            self.backfill(options['batch_size'])
+        groups = (Address.objects.order_by().values('fingerprint')
+                  .annotate(count=Count('pk'), keep=Min('pk')).filter(count__gt=1))
+        merged = 0
+        skipped = 0
+        for group in groups.iterator():
+            dupes = list(Address.objects.filter(fingerprint=group['fingerprint'])
+                         .exclude(pk=group['keep']).values_list('pk', flat=True))
+            conflict = self.conflict(group['keep'], dupes)
+            if conflict is not None:
+                self.stderr.write('Not merging addresses %s: %s' % (
+                    ', '.join(str(pk) for pk in [group['keep']] + dupes), conflict
+                ))
+                skipped += 1
+                continue
+            if not options['dry_run']:
+                self.merge(group['keep'], dupes)
+            merged += len(dupes)
+        self.stdout.write('%s %d duplicate addresses.' % ('Found' if options['dry_run'] else 'Merged', merged))
+        if skipped:
+            self.stdout.write('Skipped %d groups with conflicting links.' % skipped)
+
+    def backfill(self, batch_size):
+        last_pk = 0
+        filled = 0
+        while True:
+            batch = list(Address.objects.filter(pk__gt=last_pk, fingerprint='').order_by('pk')[:batch_size])
+            if not batch:
+                break
+            for address in batch:
+                address.fingerprint = address.get_fingerprint()
+            with transaction.atomic():
+                compat_bulk_update(Address, batch, ['fingerprint'])
+            last_pk = batch[-1].pk
+            filled += len(batch)
+        self.stdout.write('Fingerprinted %d addresses.' % filled)
+
+    def relations(self):
+        # Include hidden relations, such as AddressFields with a related_name
+        # of '+', which would otherwise be deleted along with the duplicates.
+        return [f for f in Address._meta.get_fields(include_hidden=True) if f.auto_created and not f.concrete]
+
+    def conflict(self, keep, dupes):
+        """
+        Describe why the addresses can't be merged without losing data, or
+        return `None` if they can.
+        """
+        pks = [keep] + dupes
+        for rel in self.relations():
+            model = rel.related_model
+            if rel.field.one_to_one:
+                if model._base_manager.filter(**{rel.field.attname + '__in': pks}).count() > 1:
+                    return 'more than one %s is linked one-to-one' % model._meta.label
+            elif rel.field.many_to_many and not rel.through._meta.auto_created:
+                # Rows of an explicit through model may hold their own data.
+                through, source, target = self.through(rel)
+                linked = (through._base_manager.filter(**{target + '__in': pks}).order_by()
+                          .values(source).annotate(count=Count('pk')).filter(count__gt=1))
+                if linked.exists():
+                    return 'the same %s is linked through %s more than once' % (
+                        rel.field.model._meta.label, through._meta.label
+                    )
+        return None
+
+    def through(self, rel):
+        """
+        Return the through model of a many-to-many relation to addresses,
+        with the names of its foreign keys to the other model and to addresses.
+        """
+        field = rel.field
+        return field.remote_field.through, field.m2m_field_name(), field.m2m_reverse_field_name()
+
+    @transaction.atomic
+    def merge(self, keep, dupes):
+        relations = self.relations()
+        throughs = set()
+        for rel in relations:
+            if not rel.field.many_to_many:
+                continue
+
+            # Repoint the links of each duplicate, dropping any the kept
+            # address already has.
+            through, source, target = self.through(rel)
+            throughs.add(through)
+            manager = through._base_manager
+            linked = set(manager.filter(**{target: keep}).values_list(source + '_id', flat=True))
+            repoint, drop = [], []
+            for pk, source_id in manager.filter(**{target + '__in': dupes}).values_list('pk', source + '_id'):
+                if source_id in linked:
+                    drop.append(pk)
+                else:
+                    linked.add(source_id)
+                    repoint.append(pk)
+            manager.filter(pk__in=drop).delete()
+            manager.filter(pk__in=repoint).update(**{target: keep})
+
+        for rel in relations:
+            if (rel.field.many_to_one or rel.field.one_to_one) and rel.related_model not in throughs:
+                name = rel.field.attname
+                rel.related_model._base_manager.filter(**{name + '__in': dupes}).update(**{name: keep})
+        Address.objects.filter(pk__in=dupes).delete()
@@ -0,0 +1,52 @@
+from datetime import timedelta
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from address.models import GeocodeResult
+
+
+class Command(BaseCommand):
+    help = ('Delete cached geocoder results older than ADDRESS_GEOCODE_CACHE_TTL, then the oldest beyond '
+            '--max-entries, in batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-entries', type=int,
+                            help='Number of results to keep at most.')
+        parser.add_argument('--clear', action='store_true',
+                            help='Delete every cached result.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of results to delete per query.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        qs = GeocodeResult.objects.all()
+        if options['clear']:
+            deleted = self.delete(qs)
+        else:
+            deleted = 0
+            ttl = getattr(settings, 'ADDRESS_GEOCODE_CACHE_TTL', 30 * 24 * 60 * 60)
+            if ttl:
+                deleted += self.delete(qs.filter(created__lt=timezone.now() - timedelta(seconds=ttl)))
+            if options['max_entries'] is not None:
+                excess = qs.count() - options['max_entries']
+                if excess > 0:
+                    deleted += self.delete(qs.order_by('created', 'pk'), excess)
+        self.stdout.write('Evicted %d geocoder results.' % deleted)
+
+    def delete(self, qs, limit=None):
+        deleted = 0
+        while limit is None or deleted < limit:
+            size = self.options['batch_size'] if limit is None else min(self.options['batch_size'], limit - deleted)
+            pks = list(qs.values_list('pk', flat=True)[:size])
+            if not pks:
+                break
+            GeocodeResult.objects.filter(pk__in=pks).delete()
+            deleted += len(pks)
+            if self.options['sleep']:
+                time.sleep(self.options['sleep'])
+        return deleted
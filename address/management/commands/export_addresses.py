@@ -0,0 +1,34 @@
+import io
+
+from django.core.management.base import BaseCommand
+
+from address.export import iter_addresses, write_csv, write_jsonl
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+}
+
+
+class Command(BaseCommand):
+    help = 'Stream every address, with its locality, state and country, to a CSV or JSON Lines file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-',
+                            help='File to write to, or - for standard output.')
+        parser.add_argument('--format', choices=sorted(WRITERS), default='csv')
+        parser.add_argument('--country', help='Only export addresses in this country (name or code).')
+        parser.add_argument('--state', help='Only export addresses in this state (name or code).')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Number of rows fetched from the database at a time.')
+
+    def handle(self, *args, **options):
+        addresses = iter_addresses(country=options['country'], state=options['state'],
+                                   chunk_size=options['chunk_size'])
+        write = WRITERS[options['format']]
+        if options['path'] == '-':
+            count = write(addresses, self.stdout)
+        else:
+            with io.open(options['path'], 'w', encoding='utf-8', newline='') as stream:
+                count = write(addresses, stream)
+        self.stderr.write('Exported %d addresses.' % count)
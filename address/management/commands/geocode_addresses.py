@@ -0,0 +1,128 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from address.compat import compat_bulk_update
+from address.geocoders import geocode, get_geocoder
+from address.models import (FORMATTED_LENGTH, Address, Country, InconsistentDictError, State,
+                            _bulk_resolve_localities, _clean_code, _clean_components, search_key)
+
+FIELDS = ['street_number', 'route', 'locality', 'formatted', 'formatted_derived', 'latitude', 'longitude',
+          'fingerprint', 'geohash', 'display', 'search']
+
+
+class Command(BaseCommand):
+    help = ('Resolve the raw string of every address without a locality, in batches of increasing primary '
+            'key, and attach the localities found with one update per batch. An interrupted run resumes '
+            'from its checkpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolver',
+                            help='Dotted path to a geocoder to resolve with. Defaults to ADDRESS_GEOCODER.')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of addresses to resolve and update per transaction.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Maximum number of addresses to resolve per second.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches.')
+        parser.add_argument('--limit', type=int,
+                            help='Stop after this many addresses.')
+        parser.add_argument('--checkpoint', help='File recording the last primary key processed.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore any checkpoint and start from the first address.')
+
+    def handle(self, *args, **options):
+        resolver = import_string(options['resolver'])() if options['resolver'] else get_geocoder()
+        if resolver is None:
+            raise CommandError('No geocoder is configured, set ADDRESS_GEOCODER or pass --resolver.')
+        self.resolver = resolver
+        self.interval = 1.0 / options['rate'] if options['rate'] else 0
+        self.next_at = time.time()
+        limit = options['limit']
+        checkpoint = options['checkpoint']
+
+        last_pk = 0
+        if checkpoint and not options['restart'] and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                last_pk = json.load(f)['pk']
+            self.stdout.write('Resuming after address %d.' % last_pk)
+
+        seen = resolved = 0
+        qs = Address.objects.filter(locality__isnull=True)
+        while limit is None or seen < limit:
+            size = options['batch_size'] if limit is None else min(options['batch_size'], limit - seen)
+            batch = list(qs.filter(pk__gt=last_pk).order_by('pk').only('pk', 'raw')[:size])
+            if not batch:
+                break
+            resolved += self.resolve(batch)
+            last_pk = batch[-1].pk
+            seen += len(batch)
+            if checkpoint:
+                tmp = checkpoint + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump({'pk': last_pk}, f)
+                os.rename(tmp, checkpoint)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        if checkpoint and (limit is None or seen < limit) and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write('Geocoded %d of %d addresses.' % (resolved, seen))
+
+    def components(self, raw):
+        if self.interval:
+            time.sleep(max(self.next_at - time.time(), 0))
+            self.next_at = max(self.next_at, time.time()) + self.interval
+        try:
+            components = _clean_components(geocode(raw, self.resolver) or {})
+        except InconsistentDictError:
+            return None
+        if components is None or not components['locality']:
+            return None
+        try:
+            _clean_code(Country, components['country_code'], components['country'])
+            _clean_code(State, components['state_code'], components['state'])
+        except ValueError:
+            return None
+        return components
+
+    def resolve(self, batch):
+        # Resolve outside the transaction, so slow geocoders don't hold it open.
+        found = []
+        for address in batch:
+            components = self.components(address.raw)
+            if components is not None:
+                found.append((address.pk, components))
+        if not found:
+            return 0
+
+        with transaction.atomic():
+            # Skip any resolved by someone else in the meantime.
+            addresses = Address.objects.select_for_update().in_bulk([pk for pk, c in found])
+            unresolved = [(addresses[pk], c) for pk, c in found
+                          if pk in addresses and addresses[pk].locality_id is None]
+            locality_for = _bulk_resolve_localities([c for a, c in unresolved])
+            for address, components in unresolved:
+                address.locality = locality_for(components)
+                address.street_number = components['street_number']
+                address.route = components['route']
+                if components['formatted']:
+                    address.formatted = components['formatted']
+                    address.formatted_derived = False
+                elif not address.formatted:
+                    address.formatted_derived = True
+                if address.latitude is None and components['latitude'] is not None:
+                    address.latitude = components['latitude']
+                    address.longitude = components['longitude']
+                address.fingerprint = address.get_fingerprint()
+                address.geohash = address.get_geohash()
+                if address.formatted_derived:
+                    address.formatted = address.get_display()[:FORMATTED_LENGTH]
+                address.display = address.get_display()
+                address.search = search_key(address.display)
+            compat_bulk_update(Address, [a for a, c in unresolved], FIELDS)
+        return len(unresolved)
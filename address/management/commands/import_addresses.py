@@ -0,0 +1,62 @@
+from itertools import islice
+import io
+import json
+import os
+
+from django.core.management.base import BaseCommand
+
+from address.importer import import_rows, read_rows
+
+
+class Command(BaseCommand):
+    help = ('Import addresses from a CSV or JSON Lines file of address components, in batches. Rejected rows '
+            'are written to a side file, and an interrupted import resumes from its last committed batch.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSON Lines file to import.')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Format of the file, guessed from its extension by default.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of rows to resolve per transaction.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes parsing, validating and normalizing rows in parallel.')
+        parser.add_argument('--rejects', help='File to write rejected rows to. Defaults to PATH.rejects.jsonl.')
+        parser.add_argument('--checkpoint', help='File recording progress. Defaults to PATH.checkpoint.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore any checkpoint and start from the first row.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        checkpoint = options['checkpoint'] or path + '.checkpoint'
+        rejects_path = options['rejects'] or path + '.rejects.jsonl'
+
+        start = 0
+        if not options['restart'] and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                start = json.load(f)['rows']
+            self.stdout.write('Resuming after row %d.' % start)
+
+        def save_checkpoint(consumed):
+            tmp = checkpoint + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'rows': start + consumed}, f)
+            os.rename(tmp, checkpoint)
+
+        rejected = [0]
+        with io.open(rejects_path, 'a' if start else 'w', encoding='utf-8') as rejects:
+            def reject(row, error):
+                rejected[0] += 1
+                messages = getattr(error, 'messages', None) or [str(error)]
+                rejects.write(json.dumps({'row': row, 'errors': messages}, sort_keys=True) + '\n')
+                rejects.flush()
+
+            # Workers parse lines themselves.
+            rows = islice(read_rows(path, options['format'], parse=options['workers'] <= 1), start, None)
+            imported = import_rows(rows, batch_size=options['batch_size'], on_reject=reject,
+                                   on_batch=save_checkpoint, workers=options['workers'])
+
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        if not rejected[0] and not start:
+            os.remove(rejects_path)
+        self.stdout.write('Imported %d addresses, rejected %d.' % (imported, rejected[0]))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from address.models import Address
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored display and search strings of every address, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of addresses to update per batch.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches.')
+
+    def handle(self, *args, **options):
+        last_pk = 0
+        refreshed = 0
+        while True:
+            pks = list(Address.objects.filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:options['batch_size']])
+            if not pks:
+                break
+            refreshed += Address.objects.filter(pk__in=pks).refresh_display()
+            last_pk = pks[-1]
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write('Refreshed %d addresses.' % refreshed)
@@ -0,0 +1,94 @@
+"""
+Hooks reporting what address resolution does, for production telemetry. A
+sink is configured with the `ADDRESS_METRICS_SINK` setting, a dotted path to
+a class or factory taking no arguments. Without one, every hook is a no-op.
+"""
+from contextlib import contextmanager
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+__all__ = ['LoggingSink', 'StatsdSink', 'get_sink', 'incr', 'timed']
+
+logger = logging.getLogger(__name__)
+
+##
+## Sinks receive counters and timings. Any object with `incr` and `timing`
+## methods will do.
+##
+class LoggingSink(object):
+
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def incr(self, name, value=1):
+        self.logger.log(self.level, 'address.%s +%d', name, value, extra={'metric': name, 'value': value})
+
+    def timing(self, name, ms):
+        self.logger.log(self.level, 'address.%s %.3fms', name, ms, extra={'metric': name, 'value': ms})
+
+class StatsdSink(object):
+    """
+    Forward to a statsd style client, such as `statsd.StatsClient`.
+    """
+
+    def __init__(self, client, prefix='address'):
+        self.client = client
+        self.prefix = prefix
+
+    def incr(self, name, value=1):
+        self.client.incr('%s.%s' % (self.prefix, name), value)
+
+    def timing(self, name, ms):
+        self.client.timing('%s.%s' % (self.prefix, name), ms)
+
+_UNSET = object()
+_sink = _UNSET
+
+def get_sink():
+    """
+    Return the configured sink, or `None` if metrics are disabled.
+    """
+    global _sink
+    if _sink is _UNSET:
+        path = getattr(settings, 'ADDRESS_METRICS_SINK', None)
+        _sink = import_string(path)() if path else None
+    return _sink
+
+def reset_sink(setting=None, **kwargs):
+    global _sink
+    if setting is None or setting == 'ADDRESS_METRICS_SINK':
+        _sink = _UNSET
+
+def incr(name, value=1):
+    sink = _sink if _sink is not _UNSET else get_sink()
+    if sink is not None and value:
+        sink.incr(name, value)
+
+@contextmanager
+def timed(name):
+    """
+    Report the wall time of the block as `<name>.time`, and the number of
+    queries it ran as `<name>.queries`.
+    """
+    sink = _sink if _sink is not _UNSET else get_sink()
+    if sink is None:
+        yield
+        return
+
+    queries = [0]
+    def count(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    start = time.time()
+    try:
+        with connection.execute_wrapper(count):
+            yield
+    finally:
+        sink.timing(name + '.time', (time.time() - start) * 1000.0)
+        sink.incr(name + '.queries', queries[0])
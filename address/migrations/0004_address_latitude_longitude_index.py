@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address', '0003_address_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='address',
+            index_together=set([('latitude', 'longitude')]),
+        ),
+    ]
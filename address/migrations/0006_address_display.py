@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address', '0005_address_geohash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='display',
+            field=models.CharField(max_length=255, blank=True, db_index=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def fill_locality_search(apps, schema_editor):
+    Locality = apps.get_model('address', 'Locality')
+    for pk, name in Locality.objects.values_list('pk', 'name').iterator():
+        Locality.objects.filter(pk=pk).update(search=name.lower())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address', '0006_address_display'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='search',
+            field=models.CharField(max_length=255, blank=True, db_index=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='locality',
+            name='search',
+            field=models.CharField(max_length=165, blank=True, db_index=True, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='locality',
+            name='postal_code',
+            field=models.CharField(max_length=10, blank=True, db_index=True),
+        ),
+        migrations.RunPython(fill_locality_search, migrations.RunPython.noop),
+    ]
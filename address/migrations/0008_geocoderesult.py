@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address', '0007_address_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeResult',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('components', models.TextField(blank=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address', '0008_geocoderesult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='formatted_derived',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,12 +1,26 @@
-from django.db import models
+from collections import OrderedDict
+from functools import partial
+import hashlib
+import math
+import re
+
+from django.conf import settings
+from django.db import IntegrityError, connection, models, transaction
 from django.core.exceptions import ValidationError
+from django.db.models import ExpressionWrapper
 from django.db.models.fields.related import ForeignObject
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt, Substr
 try:
     from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
 except ImportError:
     from django.db.models.fields.related import ReverseSingleRelatedObjectDescriptor as ForwardManyToOneDescriptor
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
+from address import geohash, metrics
+from address.cache import get_caches
+from address.compat import compat_bulk_update, compat_startswith
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -17,97 +31,191 @@ if sys.version > '3':
     basestring = (str, bytes)
     unicode = str
 
-__all__ = ['Country', 'State', 'Locality', 'Address', 'AddressField']
+__all__ = ['Country', 'State', 'Locality', 'Address', 'AddressField', 'GeocodeResult']
+
+# Mean radius of the earth.
+EARTH_RADIUS_KM = 6371.0088
+
+# Length of the formatted string of an address.
+FORMATTED_LENGTH = 200
+
+# Length of the stored display string of an address.
+DISPLAY_LENGTH = 255
 
 class InconsistentDictError(Exception):
     pass
 
-def _to_python(value):
-    raw = value.get('raw', '')
-    country = value.get('country', '')
-    country_code = value.get('country_code', '')
-    state = value.get('state', '')
-    state_code = value.get('state_code', '')
-    locality = value.get('locality', '')
-    sublocality = value.get('sublocality', '')
-    postal_code = value.get('postal_code', '')
-    street_number = value.get('street_number', '')
-    route = value.get('route', '')
-    formatted = value.get('formatted', '')
-    latitude = value.get('latitude', None)
-    longitude = value.get('longitude', None)
+def _normalize(text):
+    text = unicode(text).lower()
+    text = re.sub(r'[^\w\s]', ' ', text, flags=re.UNICODE)
+    return ' '.join(text.split())
+
+def search_key(text):
+    """
+    Fold text the way the indexed `search` columns are, for prefix searches.
+    """
+    return unicode(text).lower()
+
+def _street_key(street_number, route):
+    return u'%s|%s' % (_normalize(street_number), _normalize(route))
+
+def address_fingerprint(street_number='', route='', locality_id=None, raw='', street_key=None):
+    """
+    Hash the components identifying an address, folding case, whitespace and
+    punctuation. Addresses without any components are identified by `raw`.
+    """
+    if street_number or route or locality_id is not None:
+        if street_key is None:
+            street_key = _street_key(street_number, route)
+        key = u'c|%s|%s' % (street_key, locality_id or '')
+    else:
+        key = u'r|%s' % _normalize(raw)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def _clean_components(value):
+    if isinstance(value, PreparedComponents):
+        return value
+    components = dict(
+        raw=value.get('raw', ''),
+        country=value.get('country', ''),
+        country_code=value.get('country_code', ''),
+        state=value.get('state', ''),
+        state_code=value.get('state_code', ''),
+        locality=value.get('locality', ''),
+        postal_code=value.get('postal_code', ''),
+        street_number=value.get('street_number', ''),
+        route=value.get('route', ''),
+        formatted=value.get('formatted', ''),
+        latitude=value.get('latitude', None),
+        longitude=value.get('longitude', None),
+    )
 
     # If there is no value (empty raw) then return None.
-    if not raw:
+    if not components['raw']:
         return None
 
     # Fix issue with NYC boroughs (https://code.google.com/p/gmaps-api-issues/issues/detail?id=635)
-    if not locality and sublocality:
-        locality = sublocality
+    sublocality = value.get('sublocality', '')
+    if not components['locality'] and sublocality:
+        components['locality'] = sublocality
 
     # If we have an inconsistent set of value bail out now.
+    country, state, locality = components['country'], components['state'], components['locality']
     if (country or state or locality) and not (country and state and locality):
         raise InconsistentDictError
 
-    # Handle the country.
-    try:
-        country_obj = Country.objects.get(name=country)
-    except Country.DoesNotExist:
-        if country:
-            if len(country_code) > Country._meta.get_field('code').max_length:
-                if country_code != country:
-                    raise ValueError('Invalid country code (too long): %s'%country_code)
-                country_code = ''
-            country_obj = Country.objects.create(name=country, code=country_code)
-        else:
-            country_obj = None
+    return components
 
-    # Handle the state.
-    try:
-        state_obj = State.objects.get(name=state, country=country_obj)
-    except State.DoesNotExist:
-        if state:
-            if len(state_code) > State._meta.get_field('code').max_length:
-                if state_code != state:
-                    raise ValueError('Invalid state code (too long): %s'%state_code)
-                state_code = ''
-            state_obj = State.objects.create(name=state, code=state_code, country=country_obj)
-        else:
-            state_obj = None
+def _clean_code(model, code, name):
+    if len(code) > model._meta.get_field('code').max_length:
+        if code != name:
+            raise ValueError('Invalid %s code (too long): %s'%(model._meta.model_name, code))
+        code = ''
+    return code
 
-    # Handle the locality.
+##
+## Components cleaned ahead of resolution, along with the parts of their
+## fingerprint and geohash that don't need the database, so that the work can
+## be done elsewhere, such as in the worker processes of an import.
+##
+class PreparedComponents(dict):
+    street_key = None
+    geohash = ''
+
+def prepare_components(value):
+    """
+    Clean a dictionary of components without touching the database. Returns
+    `None` for an empty address, and raises `InconsistentDictError` or
+    `ValueError` as resolving it would. Country and state codes are left to
+    be checked by resolution, which only does so when it creates the row.
+    """
+    components = _clean_components(value)
+    if components is None or isinstance(components, PreparedComponents):
+        return components
+    prepared = PreparedComponents(components)
+    prepared.street_key = _street_key(components['street_number'], components['route'])
+    if components['latitude'] is not None and components['longitude'] is not None:
+        prepared.geohash = geohash.encode(float(components['latitude']), float(components['longitude']))
+    return prepared
+
+def _get_cached(caches, model, key, **kwargs):
+    # Stamp each tier just before reading it, and so before reading the
+    # slower tiers or the database, so a row changed meanwhile isn't cached
+    # with its old values. Tiers after a hit aren't consulted at all.
+    stamps = []
+    for cache in caches:
+        stamp = cache.stamp(key)
+        obj = cache.get(key, stamp)
+        if obj is not None:
+            metrics.incr('%s.cached' % model._meta.model_name)
+            break
+        stamps.append(stamp)
+    else:
+        obj = model.objects.get(**kwargs)
+        metrics.incr('%s.existing' % model._meta.model_name)
+
+    # Fill in any faster tiers that missed.
+    for cache, stamp in zip(caches, stamps):
+        cache.set(obj, stamp)
+    return obj
+
+def _remember(caches, obj):
+    for cache in caches:
+        cache.set_on_commit(obj)
+
+def _get_or_create(caches, model, key, build, **kwargs):
+    """
+    Fetch a hierarchy row, creating it with `build` if it doesn't exist. The
+    insert runs in a savepoint so that losing a race with a concurrent writer
+    falls back to reading the winner's row rather than failing.
+    """
     try:
-        locality_obj = Locality.objects.get(name=locality, postal_code=postal_code, state=state_obj)
-    except Locality.DoesNotExist:
-        if locality:
-            locality_obj = Locality.objects.create(name=locality, postal_code=postal_code, state=state_obj)
-        else:
-            locality_obj = None
+        return _get_cached(caches, model, key, **kwargs)
+    except model.DoesNotExist:
+        if build is None:
+            return None
+    obj = build()
+    try:
+        with transaction.atomic():
+            obj.save(force_insert=True)
+    except IntegrityError:
+        metrics.incr('%s.race' % model._meta.model_name)
+        return model.objects.get(**kwargs)
+    metrics.incr('%s.created' % model._meta.model_name)
+    _remember(caches, obj)
+    return obj
+
+def _to_python(value):
+    components = _clean_components(value)
+    if components is None:
+        return None
+    raw = components['raw']
+    street_number = components['street_number']
+    route = components['route']
+
+    locality_obj = _resolve_locality(components)
 
     # Handle the address.
-    try:
-        if not (street_number or route or locality):
-            address_obj = Address.objects.get(raw=raw)
-        else:
-            address_obj = Address.objects.get(
-                street_number=street_number,
-                route=route,
-                locality=locality_obj
-            )
-    except Address.DoesNotExist:
+    fingerprint = address_fingerprint(street_number, route, locality_obj.pk if locality_obj else None, raw)
+    address_obj = Address.objects.filter(fingerprint=fingerprint).order_by('pk').first()
+    if address_obj is not None:
+        metrics.incr('address.existing')
+    else:
+        metrics.incr('address.created')
         address_obj = Address(
             street_number=street_number,
             route=route,
             raw=raw,
             locality=locality_obj,
-            formatted=formatted,
-            latitude=latitude,
-            longitude=longitude,
+            formatted=components['formatted'],
+            latitude=components['latitude'],
+            longitude=components['longitude'],
         )
 
         # If "formatted" is empty try to construct it from other values.
         if not address_obj.formatted:
             address_obj.formatted = unicode(address_obj)
+            address_obj.formatted_derived = True
 
         # Need to save.
         address_obj.save()
@@ -115,6 +223,55 @@ def _to_python(value):
     # Done.
     return address_obj
 
+##
+## Find or create the locality, state and country of cleaned components.
+##
+def _resolve_locality(components):
+    country = components['country']
+    state = components['state']
+    locality = components['locality']
+    postal_code = components['postal_code']
+
+    caches = get_caches()
+
+    # Handle the country.
+    country_obj = _get_or_create(
+        caches, Country, ('country', country),
+        partial(_new_country, components) if country else None,
+        name=country
+    )
+
+    # Handle the state.
+    state_obj = _get_or_create(
+        caches, State, ('state', state, country_obj.pk if country_obj else None),
+        partial(_new_state, components, country_obj) if state else None,
+        name=state, country=country_obj
+    )
+
+    # Handle the locality.
+    return _get_or_create(
+        caches, Locality, ('locality', locality, postal_code, state_obj.pk if state_obj else None),
+        partial(_new_locality, components, state_obj) if locality else None,
+        name=locality, postal_code=postal_code, state=state_obj
+    )
+
+##
+## Coerce the latitude and longitude of a dictionary of components to floats,
+## or `None` if they are blank.
+##
+def clean_coordinates(value):
+    for field in ['latitude', 'longitude']:
+        if field in value:
+            if value[field]:
+                try:
+                    value[field] = float(value[field])
+                except (TypeError, ValueError):
+                    raise ValidationError('Invalid value for %(field)s', code='invalid',
+                                          params={'field': field})
+            else:
+                value[field] = None
+    return value
+
 ##
 ## Convert a dictionary to an address.
 ##
@@ -133,8 +290,24 @@ def to_python(value):
     elif isinstance(value, (int, long)):
         return value
 
-    # A string is considered a raw value.
+    # A string is considered a raw value. Reuse an existing raw-only address
+    # with the same fingerprint unless configured to always create one.
     elif isinstance(value, basestring):
+        if getattr(settings, 'ADDRESS_REUSE_RAW', True):
+            obj = Address.objects.filter(fingerprint=address_fingerprint(raw=value)).order_by('pk').first()
+            if obj is not None:
+                metrics.incr('raw.existing')
+                return obj
+
+        # Otherwise try to geocode it into components.
+        from address.geocoders import geocode
+        components = geocode(value)
+        if components is not None:
+            try:
+                return _to_python(components)
+            except (InconsistentDictError, ValueError):
+                logger.warning('Discarding inconsistent geocode of %r', value)
+        metrics.incr('raw.created')
         obj = Address(raw=value)
         obj.save()
         return obj
@@ -143,22 +316,282 @@ def to_python(value):
     elif isinstance(value, dict):
 
         # Attempt a conversion.
-        try:
-            return _to_python(value)
-        except InconsistentDictError:
-            return Address.objects.create(raw=value['raw'])
+        with metrics.timed('resolve'):
+            try:
+                return _to_python(value)
+            except InconsistentDictError:
+                metrics.incr('raw_fallback')
+                return Address.objects.create(raw=value['raw'])
+            except ValueError:
+                metrics.incr('invalid')
+                raise
 
     # Not in any of the formats I recognise.
+    metrics.incr('invalid')
     raise ValidationError('Invalid address value.')
 
+##
+## Convert many dictionaries to addresses at once. Components are deduplicated
+## in memory and each level of the hierarchy is resolved with a single lookup
+## and a single bulk insert per batch, rather than per dictionary.
+##
+def bulk_to_python(values, batch_size=250):
+    addresses = []
+    batch = []
+    for value in values:
+        batch.append(value)
+        if len(batch) >= batch_size:
+            with metrics.timed('bulk_resolve'):
+                addresses.extend(_bulk_to_python(batch))
+            batch = []
+    if batch:
+        with metrics.timed('bulk_resolve'):
+            addresses.extend(_bulk_to_python(batch))
+    return addresses
+
+def _bulk_resolve(model, wanted, queryset, key, unique=False):
+    """
+    Map each natural key in `wanted` to a saved instance, fetching existing
+    rows from `queryset` and bulk inserting the rest. `wanted` maps keys to
+    functions building the unsaved instance. For `unique` models, rows
+    inserted concurrently by another writer are skipped and read back.
+    """
+    from address.compat import compat_bulk_create_ignore_conflicts, compat_can_return_bulk_ids
+    found = {}
+    if not wanted:
+        return found
+    for obj in queryset:
+        found.setdefault(key(obj), obj)
+    missing = [build() for k, build in wanted.items() if k not in found]
+    metrics.incr('%s.existing' % model._meta.model_name, len(wanted) - len(missing))
+    metrics.incr('%s.created' % model._meta.model_name, len(missing))
+    if missing:
+        if unique:
+            compat_bulk_create_ignore_conflicts(model, missing)
+        else:
+            model.objects.bulk_create(missing)
+        if not unique and compat_can_return_bulk_ids(connection):
+            for obj in missing:
+                found[key(obj)] = obj
+        else:
+            for obj in queryset.all():
+                found.setdefault(key(obj), obj)
+    return dict((k, found[k]) for k in wanted)
+
+def _new_country(components):
+    code = _clean_code(Country, components['country_code'], components['country'])
+    return Country(name=components['country'], code=code)
+
+def _new_state(components, country_obj):
+    code = _clean_code(State, components['state_code'], components['state'])
+    return State(name=components['state'], code=code, country=country_obj)
+
+def _new_locality(components, state_obj):
+    return Locality(name=components['locality'], postal_code=components['postal_code'], state=state_obj,
+                    search=search_key(components['locality']))
+
+##
+## Find or create the localities of many cleaned components at once, with a
+## single lookup and a single bulk insert per level of the hierarchy. Returns
+## a function giving the locality of any of the components, with its state
+## and country attached.
+##
+def _bulk_resolve_localities(resolved):
+    # Handle the countries.
+    wanted = OrderedDict()
+    for r in resolved:
+        if r['country'] and r['country'] not in wanted:
+            wanted[r['country']] = partial(_new_country, r)
+    countries = _bulk_resolve(
+        Country, wanted,
+        Country.objects.filter(name__in=list(wanted)).order_by(),
+        lambda c: c.name,
+        unique=True
+    )
+
+    # Handle the states.
+    wanted = OrderedDict()
+    for r in resolved:
+        if r['state']:
+            country_obj = countries[r['country']]
+            k = (r['state'], country_obj.pk)
+            if k not in wanted:
+                wanted[k] = partial(_new_state, r, country_obj)
+    states = _bulk_resolve(
+        State, wanted,
+        State.objects.filter(name__in=set(k[0] for k in wanted), country__in=set(k[1] for k in wanted)).order_by(),
+        lambda s: (s.name, s.country_id),
+        unique=True
+    )
+
+    # Handle the localities.
+    wanted = OrderedDict()
+    for r in resolved:
+        if r['locality']:
+            state_obj = states[(r['state'], countries[r['country']].pk)]
+            k = (r['locality'], r['postal_code'], state_obj.pk)
+            if k not in wanted:
+                wanted[k] = partial(_new_locality, r, state_obj)
+    localities = _bulk_resolve(
+        Locality, wanted,
+        Locality.objects.filter(name__in=set(k[0] for k in wanted), state__in=set(k[2] for k in wanted)).order_by(),
+        lambda l: (l.name, l.postal_code, l.state_id),
+        unique=True
+    )
+
+    # Attach the hierarchy so formatting doesn't go back to the database.
+    states_by_pk = dict((s.pk, s) for s in states.values())
+    countries_by_pk = dict((c.pk, c) for c in countries.values())
+    for state_obj in states.values():
+        state_obj.country = countries_by_pk[state_obj.country_id]
+    for locality_obj in localities.values():
+        locality_obj.state = states_by_pk[locality_obj.state_id]
+
+    def locality_for(r):
+        if not r['locality']:
+            return None
+        return localities[(r['locality'], r['postal_code'], states[(r['state'], countries[r['country']].pk)].pk)]
+    return locality_for
+
+def _bulk_to_python(values):
+    from address.compat import compat_can_return_bulk_ids
+    rows = []
+    for value in values:
+        try:
+            rows.append(_clean_components(value))
+        except InconsistentDictError:
+            rows.append(InconsistentDictError)
+    resolved = [r for r in rows if r is not None and r is not InconsistentDictError]
+
+    with transaction.atomic():
+        locality_for = _bulk_resolve_localities(resolved)
+        localities_by_pk = dict((l.pk, l) for l in map(locality_for, resolved) if l is not None)
+
+        def build_address(r, locality_obj, fingerprint):
+            address_obj = Address(
+                street_number=r['street_number'],
+                route=r['route'],
+                raw=r['raw'],
+                locality=locality_obj,
+                formatted=r['formatted'],
+                latitude=r['latitude'],
+                longitude=r['longitude'],
+            )
+
+            # If "formatted" is empty try to construct it from other values,
+            # cut to fit as on save, which bulk inserts skip.
+            if not address_obj.formatted:
+                address_obj.formatted = unicode(address_obj)[:FORMATTED_LENGTH]
+                address_obj.formatted_derived = True
+            address_obj.fingerprint = fingerprint
+            if isinstance(r, PreparedComponents):
+                address_obj.geohash = r.geohash
+            else:
+                address_obj.geohash = address_obj.get_geohash()
+            address_obj.display = address_obj.get_display()
+            address_obj.search = search_key(address_obj.display)
+            return address_obj
+
+        # Handle the addresses, matched on their fingerprints.
+        fingerprints = {}
+        def fingerprint_for(r):
+            try:
+                return fingerprints[id(r)]
+            except KeyError:
+                pass
+            locality_obj = locality_for(r)
+            fingerprint = fingerprints[id(r)] = address_fingerprint(
+                r['street_number'], r['route'], locality_obj.pk if locality_obj else None, r['raw'],
+                street_key=getattr(r, 'street_key', None)
+            )
+            return fingerprint
+
+        wanted = OrderedDict()
+        for r in resolved:
+            fingerprint = fingerprint_for(r)
+            if fingerprint not in wanted:
+                wanted[fingerprint] = partial(build_address, r, locality_for(r), fingerprint)
+        addresses = _bulk_resolve(
+            Address, wanted,
+            Address.objects.filter(fingerprint__in=list(wanted)).order_by('pk'),
+            lambda a: a.fingerprint
+        )
+        for address_obj in addresses.values():
+            if address_obj.locality_id is not None:
+                address_obj.locality = localities_by_pk[address_obj.locality_id]
+
+        # Inconsistent dictionaries fall back to a raw-only address each.
+        raw_only = [Address(raw=v['raw']) for v, r in zip(values, rows) if r is InconsistentDictError]
+        metrics.incr('raw_fallback', len(raw_only))
+        for address_obj in raw_only:
+            address_obj.fingerprint = address_obj.get_fingerprint()
+            address_obj.display = address_obj.get_display()
+            address_obj.search = search_key(address_obj.display)
+        if raw_only:
+            if compat_can_return_bulk_ids(connection):
+                Address.objects.bulk_create(raw_only)
+            else:
+                for address_obj in raw_only:
+                    address_obj.save()
+
+    # Assemble the results in input order.
+    raw_only = iter(raw_only)
+    result = []
+    for r in rows:
+        if r is None:
+            result.append(None)
+        elif r is InconsistentDictError:
+            result.append(next(raw_only))
+        else:
+            result.append(addresses[fingerprint_for(r)])
+    return result
+
+##
+## Hierarchy rows remember the values addresses are formatted from, as last
+## loaded or saved, so that saving one without changing them is cheap.
+##
+class DisplayFieldsMixin(object):
+    display_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        obj = super(DisplayFieldsMixin, cls).from_db(db, field_names, values)
+        obj._display_values = obj.display_values()
+        return obj
+
+    def display_values(self):
+        return tuple(self.__dict__.get(f) for f in self.display_fields)
+
+##
+## Refresh the display of addresses below a country, state or locality when
+## it changes in a way that affects them. Newly created rows have no
+## addresses yet. Set `ADDRESS_REFRESH_DISPLAY = False` to leave the refresh
+## to the `refresh_displays` command instead.
+##
+def refresh_display(sender, instance, created=False, raw=False, **kwargs):
+    values = instance.display_values()
+    loaded, instance._display_values = getattr(instance, '_display_values', None), values
+    if created or raw or values == loaded or not getattr(settings, 'ADDRESS_REFRESH_DISPLAY', True):
+        return
+    name = instance._meta.model_name
+    if name == 'country':
+        addresses = Address.objects.filter(locality__state__country=instance)
+    elif name == 'state':
+        addresses = Address.objects.filter(locality__state=instance)
+    else:
+        addresses = Address.objects.filter(locality=instance)
+    addresses.refresh_display()
+
 ##
 ## A country.
 ##
 @python_2_unicode_compatible
-class Country(models.Model):
+class Country(DisplayFieldsMixin, models.Model):
     name = models.CharField(max_length=40, unique=True, blank=True)
     code = models.CharField(max_length=2, blank=True) # not unique as there are duplicates (IT)
 
+    display_fields = ('name', 'code')
+
     class Meta:
         verbose_name_plural = 'Countries'
         ordering = ('name',)
@@ -170,11 +603,13 @@ class Country(models.Model):
 ## A state. Google refers to this as `administration_level_1`.
 ##
 @python_2_unicode_compatible
-class State(models.Model):
+class State(DisplayFieldsMixin, models.Model):
     name = models.CharField(max_length=165, blank=True)
     code = models.CharField(max_length=3, blank=True)
     country = models.ForeignKey(Country, on_delete=models.CASCADE, related_name='states')
 
+    display_fields = ('name', 'code', 'country_id')
+
     class Meta:
         unique_together = ('name', 'country')
         ordering = ('country', 'name')
@@ -190,14 +625,36 @@ class State(models.Model):
     def to_str(self):
         return '%s'%(self.name or self.code)
 
+class LocalityQuerySet(models.QuerySet):
+
+    def with_hierarchy(self):
+        """
+        Join the state and country, so formatting localities doesn't query
+        them lazily.
+        """
+        return self.select_related('state__country')
+
+    def search(self, prefix):
+        """
+        Filter to localities whose name or postal code starts with `prefix`,
+        ignoring case in names.
+        """
+        return self.filter(compat_startswith(connection, 'search', search_key(prefix)) |
+                           compat_startswith(connection, 'postal_code', prefix))
+
 ##
 ## A locality (suburb).
 ##
 @python_2_unicode_compatible
-class Locality(models.Model):
+class Locality(DisplayFieldsMixin, models.Model):
     name = models.CharField(max_length=165, blank=True)
-    postal_code = models.CharField(max_length=10, blank=True)
+    postal_code = models.CharField(max_length=10, blank=True, db_index=True)
     state = models.ForeignKey(State, on_delete=models.CASCADE, related_name='localities')
+    search = models.CharField(max_length=165, blank=True, db_index=True, editable=False)
+
+    objects = LocalityQuerySet.as_manager()
+
+    display_fields = ('name', 'postal_code', 'state_id')
 
     class Meta:
         verbose_name_plural = 'Localities'
@@ -217,6 +674,128 @@ class Locality(models.Model):
             txt += ', %s'%cntry
         return txt
 
+    def save(self, *args, **kwargs):
+        self.search = search_key(self.name)
+        super(Locality, self).save(*args, **kwargs)
+
+class AddressQuerySet(models.QuerySet):
+
+    def with_hierarchy(self):
+        """
+        Join the locality, state and country, so formatting addresses or
+        calling `as_dict` doesn't query them lazily.
+        """
+        return self.select_related('locality__state__country')
+
+    def with_distance(self, latitude, longitude):
+        """
+        Annotate each address with its great circle distance in kilometres from
+        the given point, as `distance`, using the haversine formula.
+        """
+        lat = math.radians(latitude)
+        dlat = Radians(models.F('latitude')) - models.Value(lat, output_field=models.FloatField())
+        dlng = Radians(models.F('longitude')) - models.Value(math.radians(longitude), output_field=models.FloatField())
+        half_chord = (
+            Power(Sin(dlat / 2.0), 2) +
+            models.Value(math.cos(lat), output_field=models.FloatField()) *
+            Cos(Radians(models.F('latitude'))) * Power(Sin(dlng / 2.0), 2)
+        )
+        return self.annotate(distance=ExpressionWrapper(
+            2.0 * EARTH_RADIUS_KM * ASin(Sqrt(half_chord)), output_field=models.FloatField()
+        ))
+
+    def within_bounds(self, latitude, longitude, km):
+        """
+        Filter to addresses inside a box bounding a circle of `km` kilometres
+        around the given point. This uses the latitude/longitude index.
+        """
+        dlat = math.degrees(km / EARTH_RADIUS_KM)
+        qs = self.filter(latitude__gte=latitude - dlat, latitude__lte=latitude + dlat)
+        cos_lat = min(math.cos(math.radians(latitude - dlat)), math.cos(math.radians(latitude + dlat)))
+        if latitude + dlat >= 90 or latitude - dlat <= -90 or cos_lat <= 0:
+            return qs.filter(longitude__isnull=False)
+        dlng = math.degrees(km / (EARTH_RADIUS_KM * cos_lat))
+        if dlng >= 180:
+            return qs.filter(longitude__isnull=False)
+        west, east = longitude - dlng, longitude + dlng
+
+        # Split boxes crossing the antimeridian in two.
+        if west < -180:
+            return qs.filter(models.Q(longitude__gte=west + 360) | models.Q(longitude__lte=east))
+        elif east > 180:
+            return qs.filter(models.Q(longitude__gte=west) | models.Q(longitude__lte=east - 360))
+        return qs.filter(longitude__gte=west, longitude__lte=east)
+
+    def within_radius(self, latitude, longitude, km):
+        """
+        Filter to addresses within `km` kilometres of the given point,
+        annotated with their `distance`.
+        """
+        return (self.within_bounds(latitude, longitude, km)
+                .with_distance(latitude, longitude)
+                .filter(distance__lte=km))
+
+    def geohash_counts(self, precision):
+        """
+        Count addresses per geohash cell of `precision` characters, such as
+        the tiles of a map zoom level, in a single grouped query.
+        """
+        return (self.exclude(geohash='')
+                .annotate(cell=Substr('geohash', 1, precision))
+                .order_by('cell')
+                .values('cell')
+                .annotate(count=models.Count('pk')))
+
+    def nearest(self, latitude, longitude, k, start_km=1.0):
+        """
+        Return a list of the `k` addresses nearest the given point, closest
+        first, annotated with their `distance`. The search radius starts at
+        `start_km` and doubles until enough addresses are found.
+        """
+        km = start_km
+        while True:
+            found = list(self.within_radius(latitude, longitude, km).order_by('distance')[:k])
+            if len(found) >= k or km >= math.pi * EARTH_RADIUS_KM:
+                return found
+            km *= 2
+
+    def refresh_display(self, batch_size=500):
+        """
+        Recompute the `display` and `search` of these addresses in the
+        database, along with any `formatted` derived from their components,
+        after a locality, state or country has changed. Addresses are
+        formatted in Python, as on save, in batches of `batch_size` with one
+        query for their localities and one UPDATE each. Returns the number of
+        addresses updated.
+        """
+        qs = self.order_by('pk').only('pk', 'street_number', 'route', 'raw', 'formatted', 'formatted_derived',
+                                      'locality')
+        updated, last_pk = 0, None
+        while True:
+            batch = list((qs if last_pk is None else qs.filter(pk__gt=last_pk))[:batch_size])
+            if not batch:
+                return updated
+            localities = Locality.objects.with_hierarchy().in_bulk(
+                set(a.locality_id for a in batch if a.locality_id is not None)
+            )
+            for address_obj in batch:
+                if address_obj.locality_id is not None:
+                    address_obj.locality = localities[address_obj.locality_id]
+                if address_obj.formatted_derived:
+                    address_obj.formatted = address_obj.get_display()[:FORMATTED_LENGTH]
+                address_obj.display = address_obj.get_display()
+                address_obj.search = search_key(address_obj.display)
+            compat_bulk_update(Address, batch, ['formatted', 'display', 'search'])
+            updated += len(batch)
+            last_pk = batch[-1].pk
+
+    def search(self, prefix):
+        """
+        Filter to addresses whose display starts with `prefix`, ignoring case,
+        using the indexed `search` column.
+        """
+        return self.filter(compat_startswith(connection, 'search', search_key(prefix)))
+
 ##
 ## An address. If for any reason we are unable to find a matching
 ## decomposed address we will store the raw address string in `raw`.
@@ -227,36 +806,83 @@ class Address(models.Model):
     route = models.CharField(max_length=100, blank=True)
     locality = models.ForeignKey(Locality, on_delete=models.CASCADE, related_name='addresses', blank=True, null=True)
     raw = models.CharField(max_length=200)
-    formatted = models.CharField(max_length=200, blank=True)
+    formatted = models.CharField(max_length=FORMATTED_LENGTH, blank=True)
+    formatted_derived = models.BooleanField(default=False, editable=False)
     latitude = models.FloatField(blank=True, null=True)
     longitude = models.FloatField(blank=True, null=True)
+    fingerprint = models.CharField(max_length=40, blank=True, db_index=True, editable=False)
+    geohash = models.CharField(max_length=geohash.MAX_PRECISION, blank=True, db_index=True, editable=False)
+    display = models.CharField(max_length=DISPLAY_LENGTH, blank=True, db_index=True, editable=False)
+    search = models.CharField(max_length=DISPLAY_LENGTH, blank=True, db_index=True, editable=False)
+
+    objects = AddressQuerySet.as_manager()
 
     class Meta:
         verbose_name_plural = 'Addresses'
         ordering = ('locality', 'route', 'street_number')
+        index_together = ('latitude', 'longitude')
         # unique_together = ('locality', 'route', 'street_number')
 
     def __str__(self):
-        if self.formatted != '':
+        return self.display or self.get_display()
+
+    def get_display(self):
+        if self.formatted and not self.formatted_derived:
             txt = '%s'%self.formatted
-        elif self.locality:
+        elif self.locality_id is not None:
             txt = ''
             if self.street_number:
                 txt = '%s'%self.street_number
             if self.route:
                 if txt:
-                    txt += ' %s'%self.route
+                    txt += ' '
+                txt += '%s'%self.route
             locality = '%s'%self.locality
             if txt and locality:
                 txt += ', '
             txt += locality
         else:
             txt = '%s'%self.raw
-        return txt
+        return txt[:DISPLAY_LENGTH]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        obj = super(Address, cls).from_db(db, field_names, values)
+        obj._derived_formatted = obj.__dict__.get('formatted') if obj.__dict__.get('formatted_derived') else None
+        return obj
+
+    def keep_edited_formatted(self):
+        """
+        Stop deriving `formatted` if it has been given a value other than the
+        one last derived, so the edit isn't rebuilt away on save.
+        """
+        derived = getattr(self, '_derived_formatted', None)
+        if self.formatted_derived and derived is not None and self.formatted and self.formatted != derived:
+            self.formatted_derived = False
+
+    def save(self, *args, **kwargs):
+        self.keep_edited_formatted()
+        if self.formatted_derived:
+            self.formatted = self.get_display()[:FORMATTED_LENGTH]
+        self.fingerprint = self.get_fingerprint()
+        self.geohash = self.get_geohash()
+        self.display = self.get_display()
+        self.search = search_key(self.display)
+        super(Address, self).save(*args, **kwargs)
+        self._derived_formatted = self.formatted if self.formatted_derived else None
+
+    def get_fingerprint(self):
+        return address_fingerprint(self.street_number, self.route, self.locality_id, self.raw)
+
+    def get_geohash(self):
+        if self.latitude is None or self.longitude is None:
+            return ''
+        return geohash.encode(float(self.latitude), float(self.longitude))
 
     def clean(self):
         if not self.raw:
             raise ValidationError('Addresses may not have a blank `raw` field.')
+        self.keep_edited_formatted()
 
     def as_dict(self):
         ad = dict(
@@ -278,6 +904,21 @@ class Address(models.Model):
                     ad['country_code'] = self.locality.state.country.code
         return ad
 
+##
+## A geocoder's result for a raw string, keyed on a hash of the geocoder and
+## the normalized string. Strings it couldn't resolve are kept too, with
+## empty components, so they aren't sent again either.
+##
+class GeocodeResult(models.Model):
+    key = models.CharField(max_length=40, unique=True)
+    components = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @staticmethod
+    def make_key(geocoder, raw):
+        key = u'%s|%s' % (type(geocoder).__name__, _normalize(raw))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
 class AddressDescriptor(ForwardManyToOneDescriptor):
 
     def __set__(self, inst, value):
@@ -1,19 +1,104 @@
 $(function(){
+    // The components of AddressWidget, with the geocomplete detail each is
+    // filled from.
+    var components = [['country', 'country'], ['country_code', 'country_short'],
+		      ['locality', 'locality'], ['sublocality', 'sublocality'],
+		      ['postal_code', 'postal_code'], ['route', 'route'],
+		      ['street_number', 'street_number'],
+		      ['state', 'administrative_area_level_1'],
+		      ['state_code', 'administrative_area_level_1_short'],
+		      ['formatted', 'formatted_address'],
+		      ['latitude', 'lat'], ['longitude', 'lng']];
+
     $('input.address').each(function(){
         var self = $(this);
 	var cmps = $('#' + self.attr('name') + '_components');
-	var fmtd = $('input[name="' + self.attr('name') + '_formatted"]');
+	var field = function(name){
+	    return $('input[name="' + self.attr('name') + '_' + name + '"]');
+	};
+
+	// A compact widget posts its components as one JSON object, so build
+	// unnamed fields for geocomplete to fill and serialize them on change.
+	var payload = $('input[name="' + self.attr('name') + '_components"]');
+	var save = function(){};
+	if(payload.length) {
+	    var values = {};
+	    try {
+		values = $.parseJSON(payload.val() || '{}') || {};
+	    } catch(e) {}
+	    cmps = $('<div></div>');
+	    for(var ii = 0; ii < components.length; ++ii) {
+		var value = values[components[ii][0]];
+		$('<input type="hidden">').attr('data-component', components[ii][0])
+		    .attr('data-geo', components[ii][1])
+		    .val(value === undefined || value === null ? '' : value).appendTo(cmps);
+	    }
+	    field = function(name){
+		return cmps.find('input[data-component="' + name + '"]');
+	    };
+	    save = function(){
+		var data = {};
+		cmps.find('input').each(function(){
+		    var input = $(this);
+		    if(input.val() !== '')
+			data[input.attr('data-component')] = input.val();
+		});
+		payload.val(JSON.stringify(data));
+	    };
+	    self.closest('form').on('submit', save);
+	}
+
+	var fmtd = field('formatted');
+	var cmp_names = ['country', 'country_code', 'locality', 'postal_code',
+			 'route', 'street_number', 'state', 'state_code',
+			 'formatted', 'latitude', 'longitude'];
         self.geocomplete({
             details: cmps,
             detailsAttribute: 'data-geo'
-        }).change(function(){
+        }).on('geocode:result', function(){
+	    save();
+	}).change(function(){
 	    if(self.val() != fmtd.val()) {
-		var cmp_names = ['country', 'country_code', 'locality', 'postal_code',
-				 'route', 'street_number', 'state', 'state_code',
-				 'formatted', 'latitude', 'longitude'];
 		for(var ii = 0; ii < cmp_names.length; ++ii)
-		    $('input[name="' + self.attr('name') + '_' + cmp_names[ii] + '"]').val('');
+		    field(cmp_names[ii]).val('');
+		save();
+	    }
+	});
+
+	// Suggest addresses we already have, ahead of Google's.
+	var url = self.data('autocomplete-url');
+	if(!url)
+	    return;
+	var list = $('<ul class="address-suggestions"></ul>').hide().insertAfter(self);
+	var timer = null, request = null;
+	var choose = function(suggestion){
+	    for(var ii = 0; ii < cmp_names.length; ++ii) {
+		var value = suggestion.components[cmp_names[ii]];
+		field(cmp_names[ii]).val(value === undefined ? '' : value);
 	    }
+	    fmtd.val(suggestion.text);
+	    self.val(suggestion.text);
+	    save();
+	    list.hide();
+	};
+	self.on('input', function(){
+	    clearTimeout(timer);
+	    timer = setTimeout(function(){
+		if(request)
+		    request.abort();
+		request = $.getJSON(url, {q: self.val()}, function(data){
+		    list.empty();
+		    $.each(data.addresses.concat(data.localities), function(ii, suggestion){
+			$('<li></li>').text(suggestion.text).on('mousedown', function(e){
+			    e.preventDefault();
+			    choose(suggestion);
+			}).appendTo(list);
+		    });
+		    list.toggle(list.children().length > 0);
+		});
+	    }, 150);
+	}).on('blur', function(){
+	    list.hide();
 	});
     });
 });
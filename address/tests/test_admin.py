@@ -0,0 +1,134 @@
+import json
+
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from address.admin import AddressAdmin, EstimatedCountPaginator, LocalityAdmin
+from address.models import *
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Python 3 fixes.
+import sys
+if sys.version > '3':
+    unicode = str
+
+class AdminQueryCountTestCase(TestCase):
+
+    def setUp(self):
+        self.site = AdminSite()
+        self.request = RequestFactory().get('/')
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        for ii in range(10):
+            locality = Locality.objects.create(name='Locality %d' % ii, state=vic)
+            Address.objects.create(route='Some Street', locality=locality, raw='Some Street %d' % ii)
+
+    def test_address_changelist_queryset(self):
+        qs = AddressAdmin(Address, self.site).get_queryset(self.request)
+        with self.assertNumQueries(1):
+            [unicode(ad) for ad in qs]
+
+    def test_locality_changelist_queryset(self):
+        qs = LocalityAdmin(Locality, self.site).get_queryset(self.request)
+        with self.assertNumQueries(1):
+            [unicode(locality) for locality in qs]
+
+class AddressAdminTestCase(TestCase):
+
+    def setUp(self):
+        self.site = AdminSite()
+        self.request = RequestFactory().get('/')
+        self.model_admin = AddressAdmin(Address, self.site)
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        nco = Locality.objects.create(name='Northcote', postal_code='3070', state=vic)
+        self.ad1 = Address.objects.create(street_number='1', route='Some Street', locality=nco, raw='1 Some Street')
+        self.ad2 = Address.objects.create(raw='Out the back')
+
+    def test_search(self):
+        qs, distinct = self.model_admin.get_search_results(self.request, Address.objects.all(), ' 1  some ')
+        self.assertEqual(list(qs), [self.ad1])
+        self.assertFalse(distinct)
+        qs, distinct = self.model_admin.get_search_results(self.request, Address.objects.all(), 'OUT')
+        self.assertEqual(list(qs), [self.ad2])
+
+    def test_estimated_count(self):
+        with mock.patch.object(EstimatedCountPaginator, 'estimate', return_value=5000000):
+            self.assertEqual(EstimatedCountPaginator(Address.objects.all(), 100).count, 5000000)
+            self.assertEqual(EstimatedCountPaginator(Address.objects.filter(locality=None), 100).count, 1)
+        with mock.patch.object(EstimatedCountPaginator, 'estimate', return_value=50):
+            self.assertEqual(EstimatedCountPaginator(Address.objects.all(), 100).count, 2)
+
+    def test_estimate_unsupported(self):
+        self.assertEqual(EstimatedCountPaginator(Address.objects.all(), 100).estimate(), None)
+        self.assertEqual(EstimatedCountPaginator(Address.objects.all(), 100).count, 2)
+
+@override_settings(ROOT_URLCONF='address.tests.urls')
+class AutocompleteFieldsTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        for ii in range(20):
+            state = State.objects.create(name='State %d' % ii, country=au)
+            Locality.objects.create(name='Locality %d' % ii, postal_code='30%02d' % ii, state=state)
+        self.nco = Locality.objects.create(name='Northcote', postal_code='3070', state=state)
+        self.ad = Address.objects.create(route='Some Street', locality=self.nco, raw='Some Street')
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def test_change_pages_list_only_selected(self):
+        for url, other in ((reverse('admin:address_locality_change', args=[self.nco.pk]), 'State 3'),
+                           (reverse('admin:address_address_change', args=[self.ad.pk]), 'Locality 3')):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(other, response.content.decode('utf-8'))
+
+    def test_locality_autocomplete(self):
+        url = reverse('admin:address_locality_autocomplete')
+        with self.assertNumQueries(4):
+            response = self.client.get(url, {'term': 'north'})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([r['id'] for r in data['results']], [str(self.nco.pk)])
+        self.assertEqual(data['results'][0]['text'], 'Northcote, State 19 3070, Australia')
+        response = self.client.get(url, {'term': '300'})
+        self.assertEqual(len(json.loads(response.content.decode('utf-8'))['results']), 10)
+
+    def test_state_autocomplete(self):
+        response = self.client.get(reverse('admin:address_state_autocomplete'), {'term': 'State 1'})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(data['results']), 11)
+
+@override_settings(ROOT_URLCONF='address.tests.urls')
+class ChangelistOrderingTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        self.nco = Locality.objects.create(name='Northcote', postal_code='3070', state=vic)
+        self.ad1 = Address.objects.create(route='Some Street', locality=self.nco, raw='Some Street')
+        self.ad2 = Address.objects.create(raw='Out the back')
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def assertOrderedByPk(self, url, model):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        table = model._meta.db_table
+        pages = [q['sql'] for q in queries.captured_queries
+                 if q['sql'].startswith('SELECT "%s"' % table) and 'ORDER BY' in q['sql']]
+        self.assertEqual(len(pages), 1)
+        order_by = pages[0].split('ORDER BY')[1]
+        self.assertEqual(order_by.split('LIMIT')[0].strip(), '"%s"."id" DESC' % table)
+
+    def test_address_changelist(self):
+        self.assertOrderedByPk(reverse('admin:address_address_changelist'), Address)
+
+    def test_locality_changelist(self):
+        self.assertOrderedByPk(reverse('admin:address_locality_changelist'), Locality)
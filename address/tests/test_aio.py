@@ -0,0 +1,58 @@
+import asyncio
+
+from django.test import TransactionTestCase
+from address.aio import abulk_to_python, ato_python
+from address.models import *
+from address.models import to_python
+
+class AsyncToPythonTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.ad1_dict = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'state_code': 'VIC',
+            'country': 'Australia',
+            'country_code': 'AU'
+        }
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def test_dict(self):
+        ad = self.run_async(ato_python(self.ad1_dict))
+        self.assertEqual(ad.locality.state.country.code, 'AU')
+        self.assertEqual(to_python(self.ad1_dict).pk, ad.pk)
+
+    def test_string(self):
+        ad = self.run_async(ato_python('Out the back'))
+        self.assertEqual(ad.raw, 'Out the back')
+        self.assertEqual(self.run_async(ato_python('Out the back')).pk, ad.pk)
+
+    def test_passthrough(self):
+        self.assertEqual(self.run_async(ato_python(None)), None)
+        self.assertEqual(self.run_async(ato_python(3)), 3)
+
+    def test_inconsistent(self):
+        ad = self.run_async(ato_python({'raw': 'Somewhere', 'locality': 'Northcote', 'country': 'Australia'}))
+        self.assertEqual(ad.locality, None)
+
+    def test_invalid_code(self):
+        self.ad1_dict['country_code'] = 'Something else'
+        self.assertRaises(ValueError, self.run_async, ato_python(self.ad1_dict))
+
+    def test_bulk(self):
+        res = self.run_async(abulk_to_python([self.ad1_dict, {'raw': ''}, self.ad1_dict]))
+        self.assertEqual(res[1], None)
+        self.assertEqual(res[0].pk, res[2].pk)
+        self.assertEqual(to_python(self.ad1_dict).pk, res[0].pk)
@@ -0,0 +1,176 @@
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.core.cache import caches
+from address.cache import HierarchyCache, SharedHierarchyCache, get_cache, get_caches
+from address.models import *
+from address.models import to_python
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+@override_settings(ADDRESS_CACHE_SIZE=100)
+class HierarchyCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.au_vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        self.au_vic_nco = Locality.objects.create(name='Northcote', postal_code='3070', state=self.au_vic)
+        self.ad1_dict = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'state_code': 'VIC',
+            'country': 'Australia',
+            'country_code': 'AU'
+        }
+
+    def test_disabled_by_default(self):
+        with self.settings(ADDRESS_CACHE_SIZE=0):
+            self.assertEqual(get_cache(), None)
+
+    def test_hierarchy_cached(self):
+        to_python(self.ad1_dict)
+        with self.assertNumQueries(1):
+            ad = to_python(self.ad1_dict)
+        self.assertEqual(ad.locality.pk, self.au_vic_nco.pk)
+
+    def test_invalidated_on_save(self):
+        to_python(self.ad1_dict)
+        self.au_vic_nco.name = 'Fitzroy'
+        self.au_vic_nco.save()
+        ad = to_python(self.ad1_dict)
+        self.assertNotEqual(ad.locality.pk, self.au_vic_nco.pk)
+        self.assertEqual(ad.locality.name, 'Northcote')
+
+    def test_invalidated_on_delete(self):
+        to_python(self.ad1_dict)
+        self.au.delete()
+        ad = to_python(self.ad1_dict)
+        self.assertNotEqual(ad.locality.state.country.pk, self.au.pk)
+
+@override_settings(ADDRESS_CACHE_SIZE=100)
+class HierarchyCacheCommitTestCase(TransactionTestCase):
+
+    def test_parents_not_cached_with_children(self):
+        to_python({'raw': '1 Some Street', 'street_number': '1', 'route': 'Some Street',
+                   'locality': 'Northcote', 'postal_code': '3070', 'state': 'Victoria', 'state_code': 'VIC',
+                   'country': 'Australia', 'country_code': 'AU'})
+        state = State.objects.get(code='VIC')
+        state.name = 'Vic'
+        state.save()
+        country = Country.objects.get(code='AU')
+        country.name = 'Oz'
+        country.save()
+        ad = to_python({'raw': '2 Some Street', 'street_number': '2', 'route': 'Some Street',
+                        'locality': 'Northcote', 'postal_code': '3070', 'state': 'Vic', 'state_code': 'VIC',
+                        'country': 'Oz', 'country_code': 'AU'})
+        self.assertEqual(ad.formatted, '2 Some Street, Northcote, Vic 3070, Oz')
+        self.assertEqual(Address.objects.get(pk=ad.pk).display, '2 Some Street, Northcote, Vic 3070, Oz')
+
+    def test_hits_are_independent(self):
+        country = Country.objects.create(name='Australia', code='AU')
+        cache = HierarchyCache(2)
+        cache.set(country)
+        cache.get(('country', 'Australia')).name = 'Oz'
+        self.assertEqual(cache.get(('country', 'Australia')).name, 'Australia')
+
+class HierarchyCacheLRUTestCase(TestCase):
+
+    def test_bounded(self):
+        cache = HierarchyCache(2)
+        countries = [Country.objects.create(name=n) for n in ('A', 'B', 'C')]
+        for c in countries:
+            cache.set(c)
+        self.assertEqual(cache.get(('country', 'A')), None)
+        self.assertEqual(cache.get(('country', 'C')).pk, countries[2].pk)
+
+    def test_ttl(self):
+        cache = HierarchyCache(2, ttl=-1)
+        cache.set(Country.objects.create(name='A'))
+        self.assertEqual(cache.get(('country', 'A')), None)
+
+    def test_stale_set_skipped(self):
+        cache = HierarchyCache(2)
+        country = Country.objects.create(name='A')
+        stamp = cache.stamp(('country', 'A'))
+        cache.evict(country)
+        cache.set(country, stamp)
+        self.assertEqual(cache.get(('country', 'A')), None)
+        cache.set(country, cache.stamp(('country', 'A')))
+        self.assertEqual(cache.get(('country', 'A')).pk, country.pk)
+
+@override_settings(ADDRESS_CACHE_ALIAS='default',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SharedHierarchyCacheTestCase(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.au_vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        self.au_vic_nco = Locality.objects.create(name='Northcote', postal_code='3070', state=self.au_vic)
+        self.ad1_dict = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'country': 'Australia',
+        }
+
+    def test_only_shared_tier(self):
+        self.assertEqual(len(get_caches()), 1)
+
+    def test_hierarchy_cached(self):
+        to_python(self.ad1_dict)
+        with self.assertNumQueries(1):
+            ad = to_python(self.ad1_dict)
+        self.assertEqual(ad.locality.pk, self.au_vic_nco.pk)
+        self.assertEqual(ad.locality.state.code, 'VIC')
+
+    def test_invalidated_on_save(self):
+        to_python(self.ad1_dict)
+        self.au_vic_nco.name = 'Fitzroy'
+        self.au_vic_nco.save()
+        ad = to_python(self.ad1_dict)
+        self.assertNotEqual(ad.locality.pk, self.au_vic_nco.pk)
+        self.assertEqual(ad.locality.name, 'Northcote')
+
+    def test_stale_set_unreachable(self):
+        cache = SharedHierarchyCache('default')
+        stamp = cache.stamp(('country', 'Australia'))
+        self.au.name = 'Oz'
+        self.au.save()
+        self.au.name = 'Australia'
+        cache.set(self.au, stamp)
+        self.assertEqual(cache.get(('country', 'Australia')), None)
+
+    def test_lost_version_not_reused(self):
+        cache = SharedHierarchyCache('default')
+        cache.set(self.au)
+        version = cache.stamp(('country', 'Australia'))
+        caches['default'].delete('address:country:version')
+        self.assertGreater(cache.stamp(('country', 'Australia')), version)
+        self.assertEqual(cache.get(('country', 'Australia')), None)
+        caches['default'].delete('address:country:version')
+        cache.evict(self.au)
+        self.assertGreater(cache.stamp(('country', 'Australia')), version)
+
+    def test_fills_local_tier(self):
+        to_python(self.ad1_dict)
+        with self.settings(ADDRESS_CACHE_SIZE=100):
+            to_python(self.ad1_dict)
+            self.assertEqual(get_cache().get(('country', 'Australia')).pk, self.au.pk)
+
+    def test_local_hit_skips_shared_tier(self):
+        with self.settings(ADDRESS_CACHE_SIZE=100):
+            to_python(self.ad1_dict)
+            with mock.patch.object(SharedHierarchyCache, 'stamp') as stamp, \
+                 mock.patch.object(SharedHierarchyCache, 'get') as get:
+                with self.assertNumQueries(1):
+                    to_python(self.ad1_dict)
+            self.assertFalse(stamp.called)
+            self.assertFalse(get.called)
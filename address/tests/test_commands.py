@@ -0,0 +1,508 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.apps import apps
+from django.core.management.base import CommandError
+from django.db import connection, models
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from address.models import *
+from address.models import to_python
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Python 3 fixes.
+import sys
+if sys.version > '3':
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
+class DedupeAddressesTestCase(TestCase):
+
+    def setUp(self):
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.au_vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        self.au_vic_nco = Locality.objects.create(name='Northcote', postal_code='3070', state=self.au_vic)
+        self.ad1 = Address.objects.create(street_number='1', route='Some Street', locality=self.au_vic_nco,
+                                          raw='1 Some Street, Northcote, Victoria')
+        self.ad2 = Address.objects.create(street_number='1', route='some street.', locality=self.au_vic_nco,
+                                          raw='1 some street., Northcote, Victoria')
+        self.ad3 = Address.objects.create(raw='Out the back')
+        self.ad4 = Address.objects.create(raw='out  the BACK')
+        Address.objects.filter(pk=self.ad4.pk).update(fingerprint='')
+
+    def test_fingerprint_normalized(self):
+        self.assertEqual(self.ad1.fingerprint, self.ad2.fingerprint)
+        self.assertNotEqual(self.ad1.fingerprint, self.ad3.fingerprint)
+
+    def test_to_python_matches_fingerprint(self):
+        ad = to_python({
+            'raw': '1 SOME STREET, Northcote',
+            'street_number': '1',
+            'route': 'SOME STREET',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'country': 'Australia',
+        })
+        self.assertEqual(ad.pk, self.ad1.pk)
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('dedupe_addresses', dry_run=True, stdout=out)
+        self.assertIn('Not checking 1 addresses without a fingerprint.', out.getvalue())
+        self.assertIn('Found 1 duplicate addresses.', out.getvalue())
+        self.assertEqual(Address.objects.count(), 4)
+        self.assertEqual(Address.objects.get(pk=self.ad4.pk).fingerprint, '')
+
+    def test_merge(self):
+        call_command('dedupe_addresses', stdout=StringIO())
+        self.assertEqual(sorted(Address.objects.values_list('pk', flat=True)), [self.ad1.pk, self.ad3.pk])
+
+
+def link_models():
+    """
+    Build models linking to addresses in every way the dedupe command has to
+    repoint. They're registered with the address app only while in use.
+    """
+    class Meta:
+        app_label = 'address'
+
+    def model(name, **fields):
+        fields.update({'__module__': __name__, 'Meta': Meta})
+        return type(name, (models.Model,), fields)
+
+    owner = model('DedupeOwner', address=AddressField(related_name='+'))
+    profile = model('DedupeProfile', address=models.OneToOneField(Address, null=True, on_delete=models.SET_NULL))
+    tag = model('DedupeTag', addresses=models.ManyToManyField(Address, related_name='+'))
+    route = model('DedupeRoute')
+    visit = model('DedupeVisit', route=models.ForeignKey(route, on_delete=models.CASCADE),
+                  address=models.ForeignKey(Address, on_delete=models.CASCADE), note=models.CharField(max_length=20))
+    route.add_to_class('addresses', models.ManyToManyField(Address, through=visit))
+    return [owner, profile, tag, route, visit]
+
+class DedupeLinksTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.models = link_models()
+        with connection.schema_editor() as editor:
+            for model in cls.models:
+                editor.create_model(model)
+        super(DedupeLinksTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(DedupeLinksTestCase, cls).tearDownClass()
+        with connection.schema_editor() as editor:
+            for model in reversed(cls.models):
+                editor.delete_model(model)
+        registered = apps.all_models['address']
+        for model in cls.models:
+            for field in model._meta.local_many_to_many:
+                if field.remote_field.through._meta.auto_created:
+                    registered.pop(field.remote_field.through._meta.model_name)
+            registered.pop(model._meta.model_name)
+        apps.clear_cache()
+
+    def setUp(self):
+        self.owner, self.profile, self.tag, self.route, self.visit = self.models
+        self.ad1 = Address.objects.create(raw='Out the back')
+        self.ad2 = Address.objects.create(raw='out  the BACK')
+        self.ad3 = Address.objects.create(raw='OUT THE BACK')
+
+    def test_merge(self):
+        owner = self.owner.objects.create(address=self.ad2)
+        profile = self.profile.objects.create(address=self.ad3)
+        tag1 = self.tag.objects.create()
+        tag1.addresses.add(self.ad1, self.ad2)
+        tag2 = self.tag.objects.create()
+        tag2.addresses.add(self.ad2, self.ad3)
+        route = self.route.objects.create()
+        self.visit.objects.create(route=route, address=self.ad2, note='gate code')
+        call_command('dedupe_addresses', stdout=StringIO())
+        self.assertEqual(list(Address.objects.values_list('pk', flat=True)), [self.ad1.pk])
+        self.assertEqual(self.owner.objects.get(pk=owner.pk).address_id, self.ad1.pk)
+        self.assertEqual(self.profile.objects.get(pk=profile.pk).address_id, self.ad1.pk)
+        self.assertEqual(list(tag1.addresses.all()), [self.ad1])
+        self.assertEqual(list(tag2.addresses.all()), [self.ad1])
+        self.assertEqual(list(self.visit.objects.values_list('address', 'note')), [(self.ad1.pk, 'gate code')])
+
+    def test_one_to_one_conflict(self):
+        self.profile.objects.create(address=self.ad1)
+        self.profile.objects.create(address=self.ad2)
+        out, err = StringIO(), StringIO()
+        call_command('dedupe_addresses', stdout=out, stderr=err)
+        self.assertIn('Merged 0 duplicate addresses.', out.getvalue())
+        self.assertIn('Skipped 1 groups with conflicting links.', out.getvalue())
+        self.assertIn('address.DedupeProfile', err.getvalue())
+        self.assertEqual(Address.objects.count(), 3)
+        self.assertEqual(self.profile.objects.filter(address__isnull=True).count(), 0)
+
+    def test_through_conflict(self):
+        route = self.route.objects.create()
+        self.visit.objects.create(route=route, address=self.ad1, note='front')
+        self.visit.objects.create(route=route, address=self.ad3, note='back')
+        err = StringIO()
+        call_command('dedupe_addresses', stdout=StringIO(), stderr=err)
+        self.assertIn('address.DedupeVisit', err.getvalue())
+        self.assertEqual(Address.objects.count(), 3)
+        self.assertEqual(self.visit.objects.count(), 2)
+
+    def test_backfill_batches(self):
+        Address.objects.update(fingerprint='')
+        with CaptureQueriesContext(connection) as queries:
+            call_command('dedupe_addresses', batch_size=2, stdout=StringIO(), stderr=StringIO())
+        updates = [q['sql'] for q in queries.captured_queries
+                   if q['sql'].startswith('UPDATE "address_address" SET "fingerprint"')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(Address.objects.filter(fingerprint='').count(), 0)
+
+class BenchmarkAddressesTestCase(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.baseline = os.path.join(self.dir, 'baseline.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_update_and_compare(self):
+        call_command('benchmark_addresses', calls=2, sizes=[10], baseline=self.baseline, update_baseline=True,
+                     stdout=StringIO(), stderr=StringIO())
+        with open(self.baseline) as f:
+            baselines = json.load(f)
+        results = list(baselines.values())[0]
+        self.assertIn('bulk_to_python[10]', results)
+        self.assertEqual(results['to_python_pk']['queries'], 0)
+        call_command('benchmark_addresses', calls=2, sizes=[10], baseline=self.baseline, tolerance=1000,
+                     stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Address.objects.count(), 0)
+
+    def test_independent_of_selection(self):
+        selections = [None, ['bulk_to_python', 'nearest'], ['nearest', 'to_python_dict_existing']]
+        for cases in selections:
+            call_command('benchmark_addresses', calls=2, sizes=[10], cases=cases, baseline=self.baseline,
+                         update_baseline=cases is None, tolerance=1000, stdout=StringIO(), stderr=StringIO())
+
+    def test_spatial_seeded_per_size(self):
+        def run(cases, sizes):
+            call_command('benchmark_addresses', calls=2, sizes=sizes, cases=cases, baseline=self.baseline,
+                         update_baseline=True, stdout=StringIO(), stderr=StringIO())
+            with open(self.baseline) as f:
+                return list(json.load(f).values())[0]
+        alone = run(['nearest'], [10])['nearest[10]']
+        os.remove(self.baseline)
+        after = run(['within_radius', 'nearest'], [500, 10])['nearest[10]']
+        self.assertEqual(after['queries'], alone['queries'])
+        self.assertEqual(Address.objects.count(), 0)
+
+    def test_query_regression(self):
+        call_command('benchmark_addresses', calls=2, sizes=[10], baseline=self.baseline, update_baseline=True,
+                     stdout=StringIO(), stderr=StringIO())
+        with open(self.baseline) as f:
+            baselines = json.load(f)
+        for result in baselines.values():
+            result['to_python_dict_existing']['queries'] = 0
+        with open(self.baseline, 'w') as f:
+            json.dump(baselines, f)
+        self.assertRaises(CommandError, call_command, 'benchmark_addresses', calls=2, sizes=[10],
+                          baseline=self.baseline, tolerance=1000, stdout=StringIO(), stderr=StringIO())
+
+
+class BackfillGeohashesTestCase(TestCase):
+
+    def test_backfill(self):
+        ad = Address.objects.create(raw='Melbourne', latitude=-37.8136, longitude=144.9631)
+        Address.objects.filter(pk=ad.pk).update(geohash='')
+        call_command('backfill_geohashes', batch_size=1, stdout=StringIO())
+        self.assertEqual(Address.objects.get(pk=ad.pk).geohash, ad.geohash)
+
+    def test_batches(self):
+        addresses = [Address.objects.create(raw='Melbourne %d' % ii, latitude=-37.8 - ii / 100.0, longitude=144.9)
+                     for ii in range(5)]
+        Address.objects.update(geohash='')
+        with CaptureQueriesContext(connection) as queries:
+            call_command('backfill_geohashes', batch_size=2, stdout=StringIO())
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 3)
+        for ad in addresses:
+            self.assertEqual(Address.objects.get(pk=ad.pk).geohash, ad.geohash)
+
+class ExportAddressesTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        nz = Country.objects.create(name='New Zealand', code='NZ')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        akl = State.objects.create(name='Auckland', country=nz)
+        self.nco = Locality.objects.create(name='Northcote', postal_code='3070', state=vic)
+        self.akl = Locality.objects.create(name='Auckland', state=akl)
+        self.ad1 = Address.objects.create(street_number='1', route='Some Street', locality=self.nco,
+                                          raw='1 Some Street', latitude=-37.77, longitude=145.0)
+        self.ad2 = Address.objects.create(route='Queen Street', locality=self.akl, raw='Queen Street')
+        self.ad3 = Address.objects.create(raw='Out the back')
+
+    def test_iter_addresses(self):
+        from address.export import iter_addresses
+        with self.assertNumQueries(1):
+            rows = list(iter_addresses(chunk_size=2))
+        self.assertEqual([r['id'] for r in rows], [self.ad1.pk, self.ad2.pk, self.ad3.pk])
+        expected = self.ad1.as_dict()
+        for key, value in expected.items():
+            self.assertEqual(rows[0][key], value)
+        self.assertEqual(rows[2]['country'], None)
+
+    def test_filters(self):
+        from address.export import iter_addresses
+        self.assertEqual([r['id'] for r in iter_addresses(country='NZ')], [self.ad2.pk])
+        self.assertEqual([r['id'] for r in iter_addresses(state='Victoria')], [self.ad1.pk])
+
+    def test_jsonl(self):
+        out = StringIO()
+        call_command('export_addresses', format='jsonl', stdout=out, stderr=StringIO())
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[1])['locality'], 'Auckland')
+
+    def test_csv(self):
+        path = os.path.join(tempfile.mkdtemp(), 'addresses.csv')
+        try:
+            call_command('export_addresses', path, country='AU', stdout=StringIO(), stderr=StringIO())
+            with open(path) as f:
+                lines = f.read().splitlines()
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('id,raw,formatted'))
+        self.assertIn('Northcote,3070,Victoria,VIC,Australia,AU', lines[1])
+
+class ImportAddressesTestCase(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rows = [
+            {'raw': '1 Some Street, Northcote', 'street_number': '1', 'route': 'Some Street',
+             'locality': 'Northcote', 'postal_code': '3070', 'state': 'Victoria', 'country': 'Australia',
+             'latitude': '-37.77', 'longitude': '145.0'},
+            {'raw': 'Bad coordinates', 'latitude': 'x'},
+            {'raw': ''},
+            {'raw': '2 Queen Street, Auckland', 'street_number': '2', 'route': 'Queen Street',
+             'locality': 'Auckland', 'state': 'Auckland', 'country': 'New Zealand',
+             'country_code': 'Something else'},
+            {'raw': 'Out the back', 'latitude': None},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_jsonl(self, rows):
+        path = os.path.join(self.dir, 'addresses.jsonl')
+        with open(path, 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+        return path
+
+    def test_jsonl(self):
+        path = self.write_jsonl(self.rows)
+        out = StringIO()
+        call_command('import_addresses', path, batch_size=2, stdout=out)
+        self.assertIn('Imported 2 addresses, rejected 3.', out.getvalue())
+        ad = Address.objects.get(street_number='1')
+        self.assertEqual(ad.latitude, -37.77)
+        self.assertEqual(ad.locality.state.country.name, 'Australia')
+        self.assertTrue(Address.objects.filter(raw='Out the back').exists())
+        with open(path + '.rejects.jsonl') as f:
+            rejects = [json.loads(line) for line in f]
+        self.assertEqual([r['row']['raw'] for r in rejects],
+                         ['Bad coordinates', '', '2 Queen Street, Auckland'])
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+    def test_codes_checked_as_on_resolution(self):
+        Country.objects.create(name='Australia', code='AU')
+        row = dict(self.rows[0], country_code='Austr')
+        path = self.write_jsonl([row, self.rows[3]])
+        out = StringIO()
+        call_command('import_addresses', path, stdout=out)
+        self.assertIn('Imported 1 addresses, rejected 1.', out.getvalue())
+        self.assertEqual(to_python(row), Address.objects.get(street_number='1'))
+        with open(path + '.rejects.jsonl') as f:
+            rejects = [json.loads(line) for line in f]
+        self.assertEqual([r['row']['raw'] for r in rejects], ['2 Queen Street, Auckland'])
+
+    def test_csv_round_trip(self):
+        to_python(self.rows[0])
+        path = os.path.join(self.dir, 'addresses.csv')
+        call_command('export_addresses', path, stdout=StringIO(), stderr=StringIO())
+        Address.objects.all().delete()
+        call_command('import_addresses', path, stdout=StringIO())
+        ad = Address.objects.get()
+        self.assertEqual(ad.raw, self.rows[0]['raw'])
+        self.assertEqual(ad.locality.name, 'Northcote')
+
+    @mock.patch('address.importer.cpu_count', return_value=4)
+    def test_workers(self, cpu_count):
+        path = self.write_jsonl(self.rows * 3)
+        out = StringIO()
+        call_command('import_addresses', path, batch_size=2, workers=2, stdout=out)
+        self.assertIn('Imported 6 addresses, rejected 9.', out.getvalue())
+        self.assertEqual(Address.objects.count(), 2)
+        with open(path + '.rejects.jsonl') as f:
+            rejects = [json.loads(line)['row']['raw'] for line in f]
+        self.assertEqual(rejects, ['Bad coordinates', '', '2 Queen Street, Auckland'] * 3)
+
+    def test_malformed_line(self):
+        path = self.write_jsonl(self.rows[:1])
+        with open(path, 'a') as f:
+            f.write('{"raw": "Truncated\n')
+            f.write(json.dumps(self.rows[4]) + '\n')
+        for workers in (1, 2):
+            out = StringIO()
+            with mock.patch('address.importer.cpu_count', return_value=4):
+                call_command('import_addresses', path, batch_size=2, workers=workers, stdout=out)
+            self.assertIn('Imported 2 addresses, rejected 1.', out.getvalue())
+            with open(path + '.rejects.jsonl') as f:
+                rejects = [json.loads(line) for line in f]
+            self.assertEqual(rejects[0]['row'], '{"raw": "Truncated')
+            self.assertTrue(rejects[0]['errors'][0].startswith('Invalid JSON: '))
+
+    def test_too_long(self):
+        path = self.write_jsonl([
+            dict(self.rows[0], postal_code='12345678901'),
+            dict(self.rows[0], raw='Long country', country='A' * 41),
+            self.rows[4],
+        ])
+        out = StringIO()
+        call_command('import_addresses', path, stdout=out)
+        self.assertIn('Imported 1 addresses, rejected 2.', out.getvalue())
+        with open(path + '.rejects.jsonl') as f:
+            errors = [json.loads(line)['errors'] for line in f]
+        self.assertEqual(errors, [['Invalid value for postal_code (longer than 10 characters)'],
+                                  ['Invalid value for country (longer than 40 characters)']])
+
+    def test_database_error(self):
+        from django.db import DataError
+        from address import importer
+        path = self.write_jsonl([self.rows[0], self.rows[4]])
+        resolve = importer.to_python
+
+        def to_python(value):
+            if value['raw'] == 'Out the back':
+                raise DataError('value too long')
+            return resolve(value)
+        with mock.patch.object(importer, 'bulk_to_python', side_effect=DataError('value too long')), \
+                mock.patch.object(importer, 'to_python', to_python):
+            out = StringIO()
+            call_command('import_addresses', path, stdout=out)
+        self.assertIn('Imported 1 addresses, rejected 1.', out.getvalue())
+        self.assertEqual(list(Address.objects.values_list('raw', flat=True)), [self.rows[0]['raw']])
+
+    def test_resume(self):
+        path = self.write_jsonl(self.rows)
+        with open(path + '.checkpoint', 'w') as f:
+            json.dump({'rows': 4}, f)
+        out = StringIO()
+        call_command('import_addresses', path, stdout=out)
+        self.assertIn('Resuming after row 4.', out.getvalue())
+        self.assertEqual(list(Address.objects.values_list('raw', flat=True)), ['Out the back'])
+
+    @mock.patch('address.importer.cpu_count', return_value=1)
+    def test_workers_capped(self, cpu_count):
+        path = self.write_jsonl(self.rows)
+        with mock.patch('address.importer.Pool') as pool:
+            call_command('import_addresses', path, workers=4, stdout=StringIO())
+        self.assertFalse(pool.called)
+        self.assertEqual(Address.objects.count(), 2)
+
+class RefreshDisplaysTestCase(TestCase):
+
+    def test_refresh(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        nco = Locality.objects.create(name='Northcote', postal_code='3070', state=vic)
+        ad1 = Address.objects.create(street_number='1', route='Some Street', locality=nco, raw='1 Some Street')
+        ad2 = Address.objects.create(raw='Out the back')
+        Address.objects.update(display='')
+        out = StringIO()
+        call_command('refresh_displays', batch_size=1, stdout=out)
+        self.assertIn('Refreshed 2 addresses.', out.getvalue())
+        self.assertEqual(Address.objects.get(pk=ad1.pk).display, ad1.display)
+        self.assertEqual(Address.objects.get(pk=ad2.pk).display, 'Out the back')
+
+class GeocodeAddressesTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        self.nco = Locality.objects.create(name='Northcote', postal_code='3070', state=vic)
+        self.ad1 = Address.objects.create(raw='1 Some Street, Northcote, VIC')
+        self.ad2 = Address.objects.create(raw='Out the back')
+        self.ad3 = Address.objects.create(raw='Northcote')
+
+    def test_requires_geocoder(self):
+        self.assertRaises(CommandError, call_command, 'geocode_addresses', stdout=StringIO())
+
+    @override_settings(ADDRESS_GEOCODER='address.geocoders.LocalGeocoder')
+    def test_geocode(self):
+        out = StringIO()
+        call_command('geocode_addresses', batch_size=1, stdout=out)
+        self.assertIn('Geocoded 2 of 3 addresses.', out.getvalue())
+        ad1 = Address.objects.get(pk=self.ad1.pk)
+        self.assertEqual((ad1.street_number, ad1.route, ad1.locality), ('1', 'Some Street', self.nco))
+        self.assertEqual(ad1.display, '1 Some Street, Northcote, Victoria 3070, Australia')
+        self.assertEqual(ad1.raw, '1 Some Street, Northcote, VIC')
+        self.assertEqual(Address.objects.get(pk=self.ad2.pk).locality, None)
+        self.assertEqual(Address.objects.get(pk=self.ad3.pk).locality, self.nco)
+
+    @override_settings(ADDRESS_GEOCODER='address.geocoders.LocalGeocoder')
+    def test_limit_and_rate(self):
+        out = StringIO()
+        with mock.patch('time.sleep') as sleep:
+            call_command('geocode_addresses', limit=2, rate=10, stdout=out)
+        self.assertIn('Geocoded 1 of 2 addresses.', out.getvalue())
+        self.assertTrue(sleep.called)
+
+    @override_settings(ADDRESS_GEOCODER='address.geocoders.LocalGeocoder')
+    def test_resume(self):
+        path = os.path.join(tempfile.mkdtemp(), 'geocode.checkpoint')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        call_command('geocode_addresses', limit=1, checkpoint=path, stdout=StringIO())
+        with open(path) as f:
+            self.assertEqual(json.load(f), {'pk': self.ad1.pk})
+        Address.objects.filter(pk=self.ad1.pk).update(locality=None)
+        out = StringIO()
+        call_command('geocode_addresses', checkpoint=path, stdout=out)
+        self.assertIn('Resuming after address %d.' % self.ad1.pk, out.getvalue())
+        self.assertIn('Geocoded 1 of 2 addresses.', out.getvalue())
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(Address.objects.get(pk=self.ad1.pk).locality, None)
+        call_command('geocode_addresses', checkpoint=path, restart=True, stdout=StringIO())
+        self.assertEqual(Address.objects.get(pk=self.ad1.pk).locality, self.nco)
+
+    def test_resolver(self):
+        out = StringIO()
+        call_command('geocode_addresses', resolver='address.tests.test_geocoders.CountingGeocoder', stdout=out)
+        self.assertIn('Geocoded 3 of 3 addresses.', out.getvalue())
+        ad2 = Address.objects.get(pk=self.ad2.pk)
+        self.assertEqual(ad2.locality.state.code, 'VIC')
+        self.assertEqual(ad2.latitude, -37.77)
+        self.assertEqual(ad2.formatted, '1 Some St, Northcote VIC 3070, Australia')
+        self.assertEqual(ad2.raw, 'Out the back')
+
+    @override_settings(ADDRESS_GEOCODER='address.geocoders.LocalGeocoder')
+    def test_one_update_per_batch(self):
+        for ii in range(10):
+            Address.objects.create(raw='%d Other Street, Northcote' % ii)
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('geocode_addresses', batch_size=20, stdout=StringIO())
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(Address.objects.filter(locality=None).count(), 1)
@@ -1,11 +1,22 @@
-from django.test import TestCase
-from django.forms import ValidationError, Form
-from address.forms import AddressField, AddressWidget
-from address.models import Address
+import re
+
+from django.test import TestCase, override_settings
+from django.forms import ValidationError, Form, formset_factory
+from address.forms import AddressField, AddressWidget, prefetch_addresses
+from address.models import Address, Country, State, Locality
+
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
 
 class TestForm(Form):
     address = AddressField()
 
+class CompactTestForm(Form):
+    address = AddressField(widget=AddressWidget(compact=True))
+
 class AddressFieldTestCase(TestCase):
 
     def setUp(self):
@@ -71,3 +82,114 @@ class AddressWidgetTestCase(TestCase):
         self.assertEqual(wid.attrs['size'], '150')
         html = wid.render('test', None)
         self.assertNotEqual(html.find('size="150"'), -1)
+
+    def test_render_escapes_components(self):
+        html = AddressWidget().render('test', {
+            'raw': 'x', 'route': '"Some" <Street> & Lane', 'latitude': -37.5,
+        })
+        self.assertIn('name="test_route" data-geo="route" value="&quot;Some&quot; &lt;Street&gt; &amp; Lane"', html)
+        self.assertIn('name="test_latitude" data-geo="lat" value="-37.5"', html)
+        self.assertEqual(html.count('<input type="hidden"'), len(AddressWidget.components))
+
+    @override_settings(USE_L10N=True, LANGUAGE_CODE='de')
+    def test_render_unlocalized_coordinates(self):
+        html = AddressWidget().render('test', {'raw': 'x', 'latitude': -37.5})
+        self.assertIn('value="-37.5"', html)
+
+    def test_autocomplete_url(self):
+        self.assertNotIn('data-autocomplete-url', AddressWidget().render('test', None))
+        html = AddressWidget(autocomplete_url='/address/autocomplete/').render('test', None)
+        self.assertIn('data-autocomplete-url="/address/autocomplete/"', html)
+
+    def test_render_pk_single_query(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        nco = Locality.objects.create(name='Northcote', postal_code='3070', state=vic)
+        ad = Address.objects.create(street_number='1', route='Some Street', locality=nco, raw='1 Some Street')
+        wid = AddressWidget()
+        with self.assertNumQueries(1):
+            html = wid.render('test', ad.pk)
+        self.assertNotEqual(html.find('value="Australia"'), -1)
+
+class CompactAddressWidgetTestCase(TestCase):
+
+    def setUp(self):
+        self.widget = AddressWidget(compact=True)
+
+    def test_render(self):
+        html = self.widget.render('test', {'raw': 'x', 'route': '"Some" Street', 'latitude': -37.5, 'locality': ''})
+        self.assertEqual(html.count('<input type="hidden"'), 1)
+        self.assertIn('name="test_components" value="{', html)
+        self.assertIn('&quot;route&quot;:&quot;\\&quot;Some\\&quot; Street&quot;', html)
+        self.assertIn('&quot;latitude&quot;:-37.5', html)
+        self.assertNotIn('locality', html)
+
+    def test_round_trip(self):
+        ad = {'raw': '1 Some Street', 'route': 'Some Street', 'street_number': '1', 'latitude': -37.5}
+        html = self.widget.render('test', ad)
+        payload = unescape(re.search(r'name="test_components" value="([^"]*)"', html).group(1))
+        value = self.widget.value_from_datadict({'test': '1 Some Street', 'test_components': payload}, {}, 'test')
+        self.assertEqual(value['route'], 'Some Street')
+        self.assertEqual(value['latitude'], '-37.5')
+        self.assertEqual(value['locality'], '')
+        self.assertEqual(value['raw'], '1 Some Street')
+        self.assertEqual(set(value), set(c[0] for c in AddressWidget.components) | {'raw'})
+
+    def test_matches_separate_fields(self):
+        data = {'test': '1 Some Street', 'test_route': 'Some Street', 'test_latitude': '-37.5'}
+        separate = AddressWidget().value_from_datadict(data, {}, 'test')
+        compact = self.widget.value_from_datadict({
+            'test': '1 Some Street', 'test_components': '{"route":"Some Street","latitude":-37.5}',
+        }, {}, 'test')
+        self.assertEqual(compact, separate)
+
+    def test_malformed(self):
+        for payload in ('{', '[1, 2]', '"x"', ''):
+            value = self.widget.value_from_datadict({'test': 'Someplace', 'test_components': payload}, {}, 'test')
+            self.assertEqual(value['raw'], 'Someplace')
+            self.assertEqual(value['route'], '')
+        value = self.widget.value_from_datadict({
+            'test': 'Someplace', 'test_components': '{"route":["x"],"locality":{"a":1}}',
+        }, {}, 'test')
+        self.assertEqual((value['route'], value['locality']), ('', ''))
+
+    def test_empty(self):
+        self.assertEqual(self.widget.value_from_datadict({'test_components': '{"route":"x"}'}, {}, 'test'), '')
+
+    def test_field_validation(self):
+        form = CompactTestForm({'address': 'Someplace', 'address_components': '{"latitude":"x"}'})
+        self.assertFalse(form.is_valid())
+        form = CompactTestForm({'address': 'Someplace', 'address_components': '{"latitude":-37.5,"longitude":144}'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['address'].raw, 'Someplace')
+        self.assertEqual(form.cleaned_data['address'].latitude, -37.5)
+
+    @override_settings(ADDRESS_WIDGET_COMPACT=True)
+    def test_setting(self):
+        self.assertTrue(AddressWidget().compact)
+        self.assertFalse(AddressWidget(compact=False).compact)
+
+class PrefetchAddressesTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        self.addresses = []
+        for ii in range(5):
+            nco = Locality.objects.create(name='Locality %d' % ii, postal_code='3070', state=vic)
+            self.addresses.append(Address.objects.create(route='Street %d' % ii, locality=nco, raw='Street %d' % ii))
+
+    def test_formset(self):
+        formset = formset_factory(TestForm, extra=0)(initial=[{'address': a.pk} for a in self.addresses])
+        with self.assertNumQueries(1):
+            prefetch_addresses(formset)
+        with self.assertNumQueries(0):
+            html = formset.as_table()
+        self.assertNotEqual(html.find('value="Locality 4"'), -1)
+
+    def test_form_with_address_instance(self):
+        form = TestForm(initial={'address': Address.objects.get(pk=self.addresses[0].pk)})
+        prefetch_addresses(form)
+        with self.assertNumQueries(0):
+            form.as_table()
+
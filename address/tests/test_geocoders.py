@@ -0,0 +1,174 @@
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from address import metrics
+from address.geocoders import GeocodeError, GoogleGeocoder, LocalGeocoder, geocode
+from address.models import *
+from address.models import to_python
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Python 3 fixes.
+import sys
+if sys.version > '3':
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
+GOOGLE_RESPONSE = {
+    'status': 'OK',
+    'results': [{
+        'formatted_address': '1 Some St, Northcote VIC 3070, Australia',
+        'geometry': {'location': {'lat': -37.77, 'lng': 145.0}},
+        'address_components': [
+            {'long_name': '1', 'short_name': '1', 'types': ['street_number']},
+            {'long_name': 'Some Street', 'short_name': 'Some St', 'types': ['route']},
+            {'long_name': 'Northcote', 'short_name': 'Northcote', 'types': ['locality', 'political']},
+            {'long_name': 'Victoria', 'short_name': 'VIC', 'types': ['administrative_area_level_1', 'political']},
+            {'long_name': 'Australia', 'short_name': 'AU', 'types': ['country', 'political']},
+            {'long_name': '3070', 'short_name': '3070', 'types': ['postal_code']},
+        ],
+    }],
+}
+
+class CountingGeocoder(object):
+    calls = []
+
+    def geocode(self, raw):
+        self.calls.append(raw)
+        if raw.startswith('Nowhere'):
+            return None
+        return dict(GoogleGeocoder().parse(raw, GOOGLE_RESPONSE))
+
+class LocalGeocoderTestCase(TestCase):
+
+    def setUp(self):
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        self.nsw = State.objects.create(name='New South Wales', code='NSW', country=self.au)
+        self.nco = Locality.objects.create(name='Northcote', postal_code='3070', state=self.vic)
+        self.rich_vic = Locality.objects.create(name='Richmond', postal_code='3121', state=self.vic)
+        self.rich_nsw = Locality.objects.create(name='Richmond', postal_code='2753', state=self.nsw)
+        self.geocoder = LocalGeocoder()
+
+    def test_parts(self):
+        res = self.geocoder.geocode('1 Some Street, Northcote, VIC 3070')
+        self.assertEqual(res['locality'], 'Northcote')
+        self.assertEqual(res['state'], 'Victoria')
+        self.assertEqual(res['country_code'], 'AU')
+        self.assertEqual((res['street_number'], res['route']), ('1', 'Some Street'))
+
+    def test_single_part(self):
+        res = self.geocoder.geocode('12A Some Street Northcote Victoria')
+        self.assertEqual(res['locality'], 'Northcote')
+        self.assertEqual((res['street_number'], res['route']), ('12A', 'Some Street'))
+
+    def test_ambiguous(self):
+        self.assertEqual(self.geocoder.geocode('Some Street, Richmond'), None)
+        self.assertEqual(self.geocoder.geocode('Some Street, Richmond NSW')['postal_code'], '2753')
+        self.assertEqual(self.geocoder.geocode('Some Street, Richmond 3121')['state'], 'Victoria')
+
+    def test_unknown(self):
+        self.assertEqual(self.geocoder.geocode('Out the back'), None)
+
+    def test_to_python(self):
+        with override_settings(ADDRESS_GEOCODER='address.geocoders.LocalGeocoder'):
+            ad = to_python('1 Some Street, Northcote, VIC 3070')
+            self.assertEqual(ad.locality, self.nco)
+            self.assertEqual(ad.raw, '1 Some Street, Northcote, VIC 3070')
+            self.assertEqual(to_python('1 some street, NORTHCOTE').pk, ad.pk)
+            self.assertEqual(to_python('Out the back').locality, None)
+        self.assertEqual(to_python('2 Some Street, Northcote').locality, None)
+        self.assertEqual(Locality.objects.count(), 3)
+
+class GoogleGeocoderTestCase(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_parse(self):
+        res = GoogleGeocoder().parse('1 Some St', GOOGLE_RESPONSE)
+        self.assertEqual(res['raw'], '1 Some St')
+        self.assertEqual((res['street_number'], res['route']), ('1', 'Some Street'))
+        self.assertEqual((res['state'], res['state_code']), ('Victoria', 'VIC'))
+        self.assertEqual((res['latitude'], res['longitude']), (-37.77, 145.0))
+        self.assertEqual(GoogleGeocoder().parse('x', {'status': 'ZERO_RESULTS', 'results': []}), None)
+        self.assertRaises(GeocodeError, GoogleGeocoder().parse, 'x', {'status': 'OVER_QUERY_LIMIT'})
+
+    def test_cached(self):
+        geocoder = GoogleGeocoder()
+        with mock.patch.object(GoogleGeocoder, 'fetch', return_value=GOOGLE_RESPONSE) as fetch:
+            self.assertEqual(geocoder.geocode('1 Some St')['locality'], 'Northcote')
+            self.assertEqual(geocoder.geocode('1  some st.')['raw'], '1  some st.')
+        self.assertEqual(fetch.call_count, 1)
+
+    @override_settings(ADDRESS_GEOCODER='address.geocoders.GoogleGeocoder')
+    def test_errors_leave_raw(self):
+        with mock.patch.object(GoogleGeocoder, 'fetch', side_effect=GeocodeError('timed out')):
+            self.assertEqual(geocode('1 Some St'), None)
+            self.assertEqual(to_python('1 Some St').locality, None)
+
+@override_settings(ADDRESS_GEOCODER='address.tests.test_geocoders.CountingGeocoder',
+                   ADDRESS_METRICS_SINK='address.tests.test_metrics.RecordingSink')
+class GeocodeResultTestCase(TestCase):
+
+    def setUp(self):
+        CountingGeocoder.calls[:] = []
+        metrics.reset_sink()
+
+    def test_repeat_is_one_lookup(self):
+        self.assertEqual(geocode('1 Some St, Northcote')['locality'], 'Northcote')
+        with self.assertNumQueries(1):
+            res = geocode(' 1 some st northcote')
+        self.assertEqual(res['raw'], ' 1 some st northcote')
+        self.assertEqual(res['latitude'], -37.77)
+        self.assertEqual(CountingGeocoder.calls, ['1 Some St, Northcote'])
+        self.assertEqual(metrics.get_sink().counters['geocode.cache.hit'], 1)
+        self.assertEqual(metrics.get_sink().counters['geocode.cache.miss'], 1)
+
+    def test_unresolved(self):
+        self.assertEqual(geocode('Nowhere'), None)
+        self.assertEqual(geocode('Nowhere'), None)
+        self.assertEqual(CountingGeocoder.calls, ['Nowhere'])
+
+    def test_expired(self):
+        geocode('1 Some St')
+        GeocodeResult.objects.update(created=timezone.now() - timedelta(days=31))
+        geocode('1 Some St')
+        self.assertEqual(len(CountingGeocoder.calls), 2)
+        self.assertEqual(GeocodeResult.objects.count(), 1)
+        self.assertEqual(metrics.get_sink().counters['geocode.cache.expired'], 1)
+
+    def test_disabled(self):
+        with override_settings(ADDRESS_GEOCODE_CACHE_TTL=0):
+            geocode('1 Some St')
+            geocode('1 Some St')
+        self.assertEqual(len(CountingGeocoder.calls), 2)
+        self.assertEqual(GeocodeResult.objects.count(), 0)
+
+    def test_local_not_cached(self):
+        with override_settings(ADDRESS_GEOCODER='address.geocoders.LocalGeocoder'):
+            geocode('1 Some St')
+        self.assertEqual(GeocodeResult.objects.count(), 0)
+
+    def test_evict(self):
+        for ii in range(5):
+            geocode('%d Some St' % ii)
+        GeocodeResult.objects.filter(pk__in=GeocodeResult.objects.order_by('pk').values('pk')[:1]).update(
+            created=timezone.now() - timedelta(days=31)
+        )
+        out = StringIO()
+        call_command('evict_geocodes', max_entries=2, batch_size=1, stdout=out)
+        self.assertIn('Evicted 3 geocoder results.', out.getvalue())
+        self.assertEqual(
+            [r.key for r in GeocodeResult.objects.order_by('pk')],
+            [GeocodeResult.make_key(CountingGeocoder(), '%d Some St' % ii) for ii in (3, 4)]
+        )
+        call_command('evict_geocodes', clear=True, stdout=StringIO())
+        self.assertEqual(GeocodeResult.objects.count(), 0)
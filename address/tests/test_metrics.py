@@ -0,0 +1,71 @@
+from collections import defaultdict
+
+from django.test import TestCase, override_settings
+from address import metrics
+from address.models import *
+from address.models import to_python, bulk_to_python
+from django.core.exceptions import ValidationError
+
+class RecordingSink(object):
+    instances = []
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(list)
+        self.instances.append(self)
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def timing(self, name, ms):
+        self.timings[name].append(ms)
+
+@override_settings(ADDRESS_METRICS_SINK='address.tests.test_metrics.RecordingSink')
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        metrics.reset_sink()
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.au_vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        self.ad1_dict = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'country': 'Australia',
+        }
+
+    @property
+    def sink(self):
+        return metrics.get_sink()
+
+    def test_disabled(self):
+        with self.settings(ADDRESS_METRICS_SINK=None):
+            self.assertEqual(metrics.get_sink(), None)
+            to_python(self.ad1_dict)
+
+    def test_branches(self):
+        to_python(self.ad1_dict)
+        to_python(self.ad1_dict)
+        to_python({'raw': 'Somewhere', 'locality': 'Northcote', 'country': 'Australia'})
+        self.assertEqual(self.sink.counters['country.existing'], 2)
+        self.assertEqual(self.sink.counters['locality.created'], 1)
+        self.assertEqual(self.sink.counters['locality.existing'], 1)
+        self.assertEqual(self.sink.counters['address.created'], 1)
+        self.assertEqual(self.sink.counters['address.existing'], 1)
+        self.assertEqual(self.sink.counters['raw_fallback'], 1)
+        self.assertGreater(self.sink.counters['resolve.queries'], 0)
+        self.assertEqual(len(self.sink.timings['resolve.time']), 3)
+
+    def test_invalid(self):
+        self.assertRaises(ValidationError, to_python, 1.5)
+        self.assertEqual(self.sink.counters['invalid'], 1)
+
+    def test_bulk(self):
+        bulk_to_python([self.ad1_dict, self.ad1_dict])
+        self.assertEqual(self.sink.counters['country.existing'], 1)
+        self.assertEqual(self.sink.counters['locality.created'], 1)
+        self.assertEqual(self.sink.counters['address.created'], 1)
+        self.assertEqual(len(self.sink.timings['bulk_resolve.time']), 1)
@@ -1,9 +1,19 @@
+# -*- coding: utf-8 -*-
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.db import IntegrityError
 from django.core.exceptions import ValidationError
 from django.db.models import Model
+from django.forms.models import model_to_dict, modelform_factory
 from address.models import *
-from address.models import to_python
+from address import geohash
+from address.models import FORMATTED_LENGTH, to_python, bulk_to_python, prepare_components
+from address.compat import compat_bulk_create_ignore_conflicts
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 # Python 3 fixes.
 import sys
@@ -11,6 +21,9 @@ if sys.version > '3':
     long = int
     basestring = (str, bytes)
     unicode = str
+    from io import StringIO
+else:
+    from StringIO import StringIO
 
 class CountryTestCase(TestCase):
 
@@ -151,6 +164,27 @@ class AddressTestCase(TestCase):
         self.assertEqual(unicode(self.ad1), u'1 Some Street, Melbourne, Victoria 3000, Australia')
         self.assertEqual(unicode(self.ad_empty), u'Northcote, Victoria 3070, Australia')
 
+class WithHierarchyTestCase(TestCase):
+
+    def setUp(self):
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.au_vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        for ii in range(10):
+            locality = Locality.objects.create(name='Locality %d' % ii, postal_code='30%02d' % ii, state=self.au_vic)
+            Address.objects.create(street_number=str(ii), route='Some Street', locality=locality,
+                                   raw='%d Some Street' % ii)
+
+    def test_address_list_single_query(self):
+        with self.assertNumQueries(1):
+            for ad in Address.objects.with_hierarchy():
+                unicode(ad.locality)
+                ad.as_dict()
+
+    def test_locality_list_single_query(self):
+        with self.assertNumQueries(1):
+            for locality in Locality.objects.with_hierarchy():
+                unicode(locality)
+
 class AddressFieldTestCase(TestCase):
 
     class TestModel(object):
@@ -300,6 +334,16 @@ class AddressFieldTestCase(TestCase):
         self.test.address = to_python(self.ad1_dict['raw'])
         self.assertEqual(self.test.address.raw, self.ad1_dict['raw'])
 
+    def test_assignment_from_string_reuses_address(self):
+        ad = to_python(self.ad1_dict['raw'])
+        with self.assertNumQueries(1):
+            self.assertEqual(to_python(self.ad1_dict['raw']).pk, ad.pk)
+
+    def test_assignment_from_string_without_reuse(self):
+        ad = to_python(self.ad1_dict['raw'])
+        with self.settings(ADDRESS_REUSE_RAW=False):
+            self.assertNotEqual(to_python(self.ad1_dict['raw']).pk, ad.pk)
+
     # def test_save(self):
     #     self.test.address = self.ad1_dict
     #     self.test.save()
@@ -313,3 +357,340 @@ class AddressFieldTestCase(TestCase):
     #     self.assertEqual(test.address.locality.state.code, self.ad1_dict['state_code'])
     #     self.assertEqual(test.address.locality.state.country.name, self.ad1_dict['country'])
     #     self.assertEqual(test.address.locality.state.country.code, self.ad1_dict['country_code'])
+
+class BulkToPythonTestCase(TestCase):
+
+    def setUp(self):
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.au_vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        self.au_vic_nco = Locality.objects.create(name='Northcote', postal_code='3070', state=self.au_vic)
+        self.ad1 = Address.objects.create(street_number='1', route='Some Street', locality=self.au_vic_nco,
+                                          raw='1 Some Street, Northcote, Victoria')
+        self.values = [
+            {
+                'raw': '1 Some Street, Northcote, Victoria',
+                'street_number': '1',
+                'route': 'Some Street',
+                'locality': 'Northcote',
+                'postal_code': '3070',
+                'state': 'Victoria',
+                'country': 'Australia',
+            },
+            {
+                'raw': '209 Joralemon Street, Brooklyn, NY, United States',
+                'street_number': '209',
+                'route': 'Joralemon St',
+                'sublocality': 'Brooklyn',
+                'postal_code': '11201',
+                'state': 'New York',
+                'state_code': 'NY',
+                'country': 'United States',
+                'country_code': 'US',
+            },
+            {'raw': ''},
+            {'raw': 'Somewhere', 'locality': 'Northcote', 'country': 'Australia'},
+            {'raw': 'Out the back'},
+            {
+                'raw': '2 Some Street, Northcote, Victoria',
+                'street_number': '2',
+                'route': 'Some Street',
+                'locality': 'Northcote',
+                'postal_code': '3070',
+                'state': 'Victoria',
+                'country': 'Australia',
+            },
+            {'raw': 'Out the back'},
+        ]
+
+    def test_matches_to_python(self):
+        res = bulk_to_python(self.values)
+        self.assertEqual(len(res), len(self.values))
+        self.assertEqual(res[0].pk, self.ad1.pk)
+        self.assertEqual(res[1].locality.name, 'Brooklyn')
+        self.assertEqual(res[1].locality.state.code, 'NY')
+        self.assertEqual(res[1].locality.state.country.code, 'US')
+        self.assertEqual(res[2], None)
+        self.assertEqual(res[3].raw, 'Somewhere')
+        self.assertEqual(res[3].locality, None)
+        self.assertEqual(res[4].raw, 'Out the back')
+        self.assertEqual(res[4].pk, res[6].pk)
+        self.assertEqual(res[5].locality.pk, self.au_vic_nco.pk)
+        self.assertEqual(res[5].formatted, '2 Some Street, Northcote, Victoria 3070, Australia')
+        for ii in (0, 1, 4, 5):
+            self.assertEqual(to_python(self.values[ii]).pk, res[ii].pk)
+        self.assertEqual(Country.objects.count(), 2)
+        self.assertEqual(Locality.objects.count(), 2)
+
+    def test_query_count_independent_of_size(self):
+        # Inconsistent dictionaries are excluded as they each need their own row.
+        values = [v for v in self.values if v['raw'] != 'Somewhere']
+        bulk_to_python(values)
+        with self.assertNumQueries(6):
+            bulk_to_python(values * 20)
+
+    def test_invalid_country_code(self):
+        self.values[1]['country_code'] = 'Something else'
+        self.assertRaises(ValueError, bulk_to_python, self.values)
+
+    def test_long_formatted_truncated(self):
+        value = {'raw': 'Long', 'street_number': '1', 'route': 'R' * 100, 'locality': 'L' * 150,
+                 'postal_code': '3070', 'state': 'Victoria', 'country': 'Australia'}
+        ad, = bulk_to_python([value])
+        self.assertEqual(len(Address.objects.get(pk=ad.pk).formatted), FORMATTED_LENGTH)
+        self.assertEqual(ad.formatted, ad.get_display()[:FORMATTED_LENGTH])
+
+    def test_prepared_components(self):
+        values = [v for v in self.values if v['raw'] not in ('', 'Somewhere')]
+        values[0] = dict(values[0], latitude=-37.77, longitude=145.0)
+        expected = bulk_to_python(values)
+        prepared = [prepare_components(v) for v in values]
+        self.assertEqual(prepared[0].geohash, geohash.encode(-37.77, 145.0))
+        res = bulk_to_python(prepared)
+        self.assertEqual([a.pk for a in res], [a.pk for a in expected])
+        self.assertEqual(res[0].geohash, expected[0].geohash)
+        self.assertEqual(Address.objects.get(pk=res[1].pk).fingerprint, res[1].get_fingerprint())
+        self.assertEqual(prepare_components({'raw': ''}), None)
+
+        # Codes are only checked when a new country or state is created.
+        prepared = prepare_components(dict(values[1], country_code='Something else'))
+        self.assertEqual(bulk_to_python([prepared])[0].pk, expected[1].pk)
+        prepared = prepare_components(dict(values[1], country='Elsewhere', country_code='Something else'))
+        self.assertRaises(ValueError, bulk_to_python, [prepared])
+
+class ConcurrentCreationTestCase(TestCase):
+
+    def setUp(self):
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.au_vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        self.au_vic_nco = Locality.objects.create(name='Northcote', postal_code='3070', state=self.au_vic)
+        self.ad1_dict = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'country': 'Australia',
+        }
+
+    def test_lost_race_reads_winner(self):
+        # Simulate the rows being inserted by another writer between our
+        # lookup and our insert.
+        def miss(caches, model, key, **kwargs):
+            raise model.DoesNotExist
+        with mock.patch('address.models._get_cached', miss):
+            ad = to_python(self.ad1_dict)
+        self.assertEqual(ad.locality.pk, self.au_vic_nco.pk)
+        self.assertEqual(Country.objects.count(), 1)
+        self.assertEqual(Locality.objects.count(), 1)
+
+    def test_bulk_skips_conflicts(self):
+        compat_bulk_create_ignore_conflicts(Country, [Country(name='Australia'), Country(name='Belgium')])
+        self.assertEqual(Country.objects.count(), 2)
+        self.assertEqual(Country.objects.get(name='Australia').pk, self.au.pk)
+
+class GeoQueryTestCase(TestCase):
+
+    def setUp(self):
+        self.melbourne = Address.objects.create(raw='Melbourne', latitude=-37.8136, longitude=144.9631)
+        self.geelong = Address.objects.create(raw='Geelong', latitude=-38.1499, longitude=144.3617)
+        self.sydney = Address.objects.create(raw='Sydney', latitude=-33.8688, longitude=151.2093)
+        self.suva = Address.objects.create(raw='Suva', latitude=-18.1416, longitude=178.4419)
+        self.apia = Address.objects.create(raw='Apia', latitude=-13.8333, longitude=-171.7667)
+        self.nowhere = Address.objects.create(raw='Nowhere')
+
+    def test_with_distance(self):
+        ad = Address.objects.with_distance(-37.8136, 144.9631).get(pk=self.sydney.pk)
+        self.assertAlmostEqual(ad.distance, 713.8, places=0)
+
+    def test_within_radius(self):
+        qs = Address.objects.within_radius(-37.8136, 144.9631, 100)
+        self.assertEqual(set(qs), set([self.melbourne, self.geelong]))
+        qs = Address.objects.within_radius(-37.8136, 144.9631, 50)
+        self.assertEqual(list(qs), [self.melbourne])
+
+    def test_within_radius_antimeridian(self):
+        qs = Address.objects.within_radius(-18.1416, 178.4419, 1200)
+        self.assertEqual(set(qs), set([self.suva, self.apia]))
+
+    def test_nearest(self):
+        res = Address.objects.nearest(-37.8136, 144.9631, 3)
+        self.assertEqual(res, [self.melbourne, self.geelong, self.sydney])
+        self.assertEqual(len(Address.objects.nearest(0, 0, 10)), 5)
+
+class GeohashTestCase(TestCase):
+
+    def test_encode(self):
+        from address import geohash
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geohash.encode(-37.8136, 144.9631, 5), 'r1r0f')
+
+    def test_maintained_on_save(self):
+        ad = Address.objects.create(raw='Melbourne', latitude=-37.8136, longitude=144.9631)
+        self.assertTrue(ad.geohash.startswith('r1r0f'))
+        self.assertEqual(Address.objects.create(raw='Nowhere').geohash, '')
+
+    def test_maintained_in_bulk(self):
+        res = bulk_to_python([{'raw': 'Melbourne', 'latitude': -37.8136, 'longitude': 144.9631}])
+        self.assertTrue(Address.objects.get(pk=res[0].pk).geohash.startswith('r1r0f'))
+
+    def test_geohash_counts(self):
+        Address.objects.create(raw='Melbourne', latitude=-37.8136, longitude=144.9631)
+        Address.objects.create(raw='Fitzroy', latitude=-37.7984, longitude=144.9788)
+        Address.objects.create(raw='Sydney', latitude=-33.8688, longitude=151.2093)
+        Address.objects.create(raw='Nowhere')
+        with self.assertNumQueries(1):
+            counts = list(Address.objects.geohash_counts(2))
+        self.assertEqual(counts, [{'cell': 'r1', 'count': 2}, {'cell': 'r3', 'count': 1}])
+
+class DisplayTestCase(TestCase):
+
+    def setUp(self):
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        self.nco = Locality.objects.create(name='Northcote', postal_code='3070', state=self.vic)
+        self.ad1 = Address.objects.create(street_number='1', route='Some Street', locality=self.nco, raw='1 Some Street')
+        self.ad2 = Address.objects.create(route='Some Street', locality=self.nco, raw='Some Street')
+        self.ad3 = Address.objects.create(raw='Out the back', formatted='Out the back, Northcote')
+        self.ad4 = Address.objects.create(route='Some St', locality=self.nco, raw='Some St',
+                                          formatted='Unit 2, Some St, Northcote VIC 3070, Australia')
+        self.ad5 = to_python({'street_number': '5', 'route': 'Some Street', 'locality': 'Northcote',
+                              'postal_code': '3070', 'state': 'Victoria', 'state_code': 'VIC',
+                              'country': 'Australia', 'country_code': 'AU', 'raw': '5 Some Street'})
+
+    def test_saved(self):
+        self.assertEqual(self.ad1.display, '1 Some Street, Northcote, Victoria 3070, Australia')
+        self.assertEqual(self.ad2.display, 'Some Street, Northcote, Victoria 3070, Australia')
+        self.assertEqual(self.ad3.display, 'Out the back, Northcote')
+        self.assertEqual(self.ad4.display, 'Unit 2, Some St, Northcote VIC 3070, Australia')
+        self.assertEqual(self.ad5.display, '5 Some Street, Northcote, Victoria 3070, Australia')
+        self.assertEqual(self.ad5.formatted, self.ad5.display)
+        self.assertTrue(self.ad5.formatted_derived)
+
+    def test_str_without_queries(self):
+        expected = dict((ad.pk, ad.display) for ad in (self.ad1, self.ad2, self.ad3, self.ad4, self.ad5))
+        addresses = list(Address.objects.all())
+        with self.assertNumQueries(0):
+            for ad in addresses:
+                self.assertEqual(unicode(ad), expected[ad.pk])
+
+    def test_rename(self):
+        self.nco.name = 'Thornbury'
+        self.nco.save()
+        self.assertEqual(Address.objects.get(pk=self.ad1.pk).display, '1 Some Street, Thornbury, Victoria 3070, Australia')
+        self.vic.name = 'Vic'
+        self.vic.save()
+        self.assertEqual(Address.objects.get(pk=self.ad2.pk).display, 'Some Street, Thornbury, Vic 3070, Australia')
+        self.au.name = 'Oz'
+        self.au.save()
+        self.assertEqual(Address.objects.get(pk=self.ad1.pk).display, '1 Some Street, Thornbury, Vic 3070, Oz')
+        self.assertEqual(Address.objects.get(pk=self.ad3.pk).display, 'Out the back, Northcote')
+
+        # A supplied formatted string is kept, a derived one follows the rename.
+        ad4 = Address.objects.get(pk=self.ad4.pk)
+        self.assertEqual(ad4.display, 'Unit 2, Some St, Northcote VIC 3070, Australia')
+        self.assertEqual(ad4.formatted, 'Unit 2, Some St, Northcote VIC 3070, Australia')
+        ad5 = Address.objects.get(pk=self.ad5.pk)
+        self.assertEqual(ad5.display, '5 Some Street, Thornbury, Vic 3070, Oz')
+        self.assertEqual(ad5.formatted, '5 Some Street, Thornbury, Vic 3070, Oz')
+
+    def test_edit_after_derived_save(self):
+        ad5 = Address.objects.get(pk=self.ad5.pk)
+        ad5.formatted = 'Unit 5, 5 Some Street, Northcote VIC 3070'
+        ad5.save()
+        ad5.refresh_from_db()
+        self.assertEqual(ad5.formatted, 'Unit 5, 5 Some Street, Northcote VIC 3070')
+        self.assertEqual(ad5.display, 'Unit 5, 5 Some Street, Northcote VIC 3070')
+        self.assertFalse(ad5.formatted_derived)
+
+        # Saving unchanged, or clearing it, keeps deriving it.
+        ad1 = to_python({'street_number': '1', 'route': 'Other Street', 'locality': 'Northcote',
+                         'postal_code': '3070', 'state': 'Victoria', 'country': 'Australia',
+                         'raw': '1 Other Street'})
+        ad1.save()
+        self.assertTrue(Address.objects.get(pk=ad1.pk).formatted_derived)
+        ad1.formatted = ''
+        ad1.save()
+        self.assertEqual(ad1.formatted, '1 Other Street, Northcote, Victoria 3070, Australia')
+        self.assertTrue(ad1.formatted_derived)
+
+    def test_form_edit_after_derived_save(self):
+        AddressForm = modelform_factory(Address, fields=('street_number', 'route', 'locality', 'raw', 'formatted'))
+        data = model_to_dict(Address.objects.get(pk=self.ad5.pk), fields=AddressForm._meta.fields)
+        data['formatted'] = 'Unit 5, 5 Some Street, Northcote VIC 3070'
+        form = AddressForm(data, instance=Address.objects.get(pk=self.ad5.pk))
+        self.assertTrue(form.is_valid())
+        self.assertFalse(form.instance.formatted_derived)
+        form.save()
+        ad5 = Address.objects.get(pk=self.ad5.pk)
+        self.assertEqual(ad5.formatted, 'Unit 5, 5 Some Street, Northcote VIC 3070')
+        self.assertFalse(ad5.formatted_derived)
+
+    def test_refresh_matches_save(self):
+        Address.objects.update(display='')
+        self.assertEqual(Address.objects.all().refresh_display(batch_size=1), 5)
+        for ad in (self.ad1, self.ad2, self.ad3, self.ad4, self.ad5):
+            self.assertEqual(Address.objects.get(pk=ad.pk).display, ad.display)
+            self.assertEqual(Address.objects.get(pk=ad.pk).search, ad.search)
+
+    def test_unchanged_save_does_not_refresh(self):
+        au = Country.objects.get(pk=self.au.pk)
+        with self.assertNumQueries(1):
+            au.save()
+        with self.assertNumQueries(1):
+            self.nco.save()
+        self.vic.name = 'Vic'
+        self.vic.save()
+        self.assertEqual(Address.objects.get(pk=self.ad1.pk).display, '1 Some Street, Northcote, Vic 3070, Australia')
+
+    def test_refresh_deferred(self):
+        with override_settings(ADDRESS_REFRESH_DISPLAY=False):
+            self.nco.name = 'Thornbury'
+            with self.assertNumQueries(1):
+                self.nco.save()
+        self.assertEqual(Address.objects.get(pk=self.ad1.pk).display, '1 Some Street, Northcote, Victoria 3070, Australia')
+        call_command('refresh_displays', stdout=StringIO())
+        self.assertEqual(Address.objects.get(pk=self.ad1.pk).display, '1 Some Street, Thornbury, Victoria 3070, Australia')
+
+    def test_create_does_not_refresh(self):
+        with self.assertNumQueries(1):
+            Locality.objects.create(name='Fitzroy', state=self.vic)
+
+class SearchTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        self.vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        self.nco = Locality.objects.create(name='Northcote', postal_code='3070', state=self.vic)
+        self.ad1 = Address.objects.create(street_number='1', route='Some Street', locality=self.nco, raw='1 Some Street')
+
+    def test_address(self):
+        self.assertEqual(list(Address.objects.search('1 SOME')), [self.ad1])
+        self.assertEqual(list(Address.objects.search('1 Some Street, Northcote, Vic')), [self.ad1])
+        self.assertEqual(list(Address.objects.search('Some')), [])
+
+    def test_locality(self):
+        self.assertEqual(list(Locality.objects.search('north')), [self.nco])
+        self.assertEqual(list(Locality.objects.search('307')), [self.nco])
+        self.assertEqual(list(Locality.objects.search('vic')), [])
+
+    def test_bulk_and_refresh(self):
+        ad = bulk_to_python([{
+            'raw': u'2 Rue Saint-Honoré', 'street_number': '2', 'route': u'Rue Saint-Honoré',
+            'locality': u'Évry', 'state': u'Île-de-France', 'country': 'France', 'country_code': 'FR',
+        }])[0]
+        self.assertEqual(list(Address.objects.search(u'2 rue saint-honoré, év')), [ad])
+        self.assertEqual(list(Locality.objects.search(u'év')), [ad.locality])
+        State.objects.filter(pk=ad.locality.state_id).update(name='Essonne')
+        Address.objects.filter(pk=ad.pk).refresh_display()
+        self.assertEqual(list(Address.objects.search(u'2 rue saint-honoré, évry, essonne')), [ad])
+
+    def test_refresh_folds_non_ascii(self):
+        ad1 = Address.objects.create(street_number='1', route=u'Äußere Str', locality=self.nco, raw=u'1 Äußere Str')
+        ad2 = Address.objects.create(raw=u'Élysée Palace')
+        for ad in (ad1, ad2):
+            self.assertEqual(list(Address.objects.search(ad.display[:8].lower())), [ad])
+        self.nco.save()
+        Address.objects.filter(pk=ad2.pk).refresh_display()
+        self.assertEqual(list(Address.objects.search(u'1 äußere str, north')), [ad1])
+        self.assertEqual(list(Address.objects.search(u'élysée')), [ad2])
@@ -0,0 +1,61 @@
+import json
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+from address.models import *
+from address.views import autocomplete
+
+class AutocompleteTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        self.nco = Locality.objects.create(name='Northcote', postal_code='3070', state=vic)
+        self.mel = Locality.objects.create(name='Melbourne', postal_code='3000', state=vic)
+        self.ad1 = Address.objects.create(street_number='1', route='Some Street', locality=self.nco, raw='1 Some Street')
+        self.ad2 = Address.objects.create(street_number='1', route='Some Street', locality=self.mel, raw='1 Some Street')
+        self.ad3 = Address.objects.create(raw='North of the river')
+        self.user = User.objects.create_user('user')
+
+    def get(self, user=None, **params):
+        request = RequestFactory().get('/', params)
+        request.user = user or self.user
+        return autocomplete(request)
+
+    def results(self, **params):
+        data = json.loads(self.get(**params).content.decode('utf-8'))
+        return [s['id'] for s in data['addresses']], [s['id'] for s in data['localities']]
+
+    def test_addresses(self):
+        self.assertEqual(self.results(q='1 some'), ([self.ad2.pk, self.ad1.pk], []))
+        self.assertEqual(self.results(q='1  SOME street, nor'), ([self.ad1.pk], []))
+        self.assertEqual(self.results(q='1 some', limit='1'), ([self.ad2.pk], []))
+
+    def test_localities(self):
+        self.assertEqual(self.results(q='nor'), ([self.ad3.pk], [self.nco.pk]))
+        self.assertEqual(self.results(q='30'), ([], [self.mel.pk, self.nco.pk]))
+
+    def test_components(self):
+        data = json.loads(self.get(q='north').content.decode('utf-8'))
+        self.assertEqual(data['localities'][0]['text'], 'Northcote, Victoria 3070, Australia')
+        self.assertEqual(data['localities'][0]['components']['state_code'], 'VIC')
+        self.assertEqual(data['addresses'][0]['components']['raw'], 'North of the river')
+
+    def test_short_query(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.results(q='n'), ([], []))
+
+    def test_queries(self):
+        with self.assertNumQueries(2):
+            self.get(q='1 some')
+
+    def test_renamed_locality(self):
+        self.nco.name = 'Thornbury'
+        self.nco.save()
+        self.assertEqual(self.results(q='1 some street, thorn'), ([self.ad1.pk], []))
+
+    def test_anonymous(self):
+        self.assertEqual(self.get(user=AnonymousUser(), q='1 some').status_code, 403)
+        with override_settings(ADDRESS_AUTOCOMPLETE_PUBLIC=True):
+            self.assertEqual(self.get(user=AnonymousUser(), q='1 some').status_code, 200)
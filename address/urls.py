@@ -0,0 +1,7 @@
+from django.conf.urls import url
+
+from address import views
+
+urlpatterns = [
+    url(r'^autocomplete/$', views.autocomplete, name='address_autocomplete'),
+]
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.http import HttpResponseForbidden, JsonResponse
+
+from address.models import Address, Locality
+
+__all__ = ['autocomplete']
+
+# Python 3 fixes.
+import sys
+if sys.version > '3':
+    unicode = str
+
+MIN_LENGTH = 2
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+def autocomplete(request):
+    """
+    Suggest stored addresses and localities starting with the `q` parameter,
+    as JSON. Each list holds at most `limit` suggestions, ordered by text.
+    Anonymous users are refused unless `ADDRESS_AUTOCOMPLETE_PUBLIC` is set,
+    since the suggestions are other people's addresses.
+    """
+    user = getattr(request, 'user', None)
+    if not getattr(settings, 'ADDRESS_AUTOCOMPLETE_PUBLIC', False) and not (user and user.is_authenticated):
+        return HttpResponseForbidden()
+
+    query = ' '.join(request.GET.get('q', '').split())
+    try:
+        limit = max(1, min(int(request.GET.get('limit', DEFAULT_LIMIT)), MAX_LIMIT))
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    if len(query) < MIN_LENGTH:
+        return JsonResponse({'addresses': [], 'localities': []})
+
+    addresses = Address.objects.with_hierarchy().search(query).order_by('search', 'pk')[:limit]
+    localities = Locality.objects.with_hierarchy().search(query).order_by('search', 'postal_code', 'pk')[:limit]
+    return JsonResponse({
+        'addresses': [
+            {'id': a.pk, 'text': unicode(a), 'components': a.as_dict()} for a in addresses
+        ],
+        'localities': [
+            {'id': l.pk, 'text': unicode(l), 'components': {
+                'locality': l.name,
+                'postal_code': l.postal_code,
+                'state': l.state.name,
+                'state_code': l.state.code,
+                'country': l.state.country.name,
+                'country_code': l.state.country.code,
+            }} for l in localities
+        ],
+    })